@@ -4,10 +4,15 @@ from azure.storage.blob import BlobServiceClient, generate_blob_sas
 from datetime import datetime, timedelta
 import os,json
 from dotenv import load_dotenv
-from utilities.azureblobstorage import get_all_files
-from utilities.utils import initialize
+from utilities.azureblobstorage import get_all_files, iter_changed_files, BlobManifest, get_blob_sas_url
+from utilities.utils import initialize, complete_prompt, ask_all_fields, get_scoped_contexts
 from utilities.utils import colorprint
 from utilities.formrecognizer import analyze_read
+from utilities.pipeline import run_batch
+from utilities.resultsink import ResultSink
+from utilities.completioncache import get_completion_cache
+from utilities.openaischeduler import get_scheduler
+from utilities.instrumentation import start_metrics_server, write_metrics, metrics
 from urllib.parse import *
 import tiktoken
 from openai.embeddings_utils import get_embedding, cosine_similarity
@@ -22,62 +27,41 @@ account_key = os.environ['BLOB_ACCOUNT_KEY']
 connect_str = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
 container_name = os.environ['BLOB_CONTAINER_NAME']
 model = os.environ['OPENAI_QnA_MODEL'] #e.g. 'text-davinci-003' deployment
+single_call = os.getenv('OPENAI_SINGLE_CALL', 'false').lower() == 'true' # ask for all fields in one completion
+incremental_sync = os.getenv('INCREMENTAL_SYNC', 'false').lower() == 'true' # only process new or changed blobs
+retrieval = os.getenv('OPENAI_RETRIEVAL', 'false').lower() == 'true' # send each field only the chunks relevant to it
 os.makedirs('data', mode = 0o777, exist_ok = True) 
+start_metrics_server() # METRICS_PORT
 
-def get_context(formUrl,file_name):
+def get_context(formUrl,file_name,cache_key=None):
     file_name_root = os.path.splitext(file_name)[0] 
     context_file_name = os.path.join('data','context_'+file_name_root+'.txt') 
     colorprint('ANALYZING FILE : '+ file_name)
-
-    try: 
-        with open(context_file_name) as f:
-            context =f.read()
-            colorprint(f"Found file {context_file_name} with extracted content for context. \nReading file, NOT sending document to Form Recognizer.",'87')
-    except:
-        colorprint('Sending the document to Form Recognizer to extract content')
-        #file_sas = generate_blob_sas(account_name, container_name, file_name, account_key= account_key, permission='r', expiry=datetime.utcnow() + timedelta(hours=1))
-        #formUrl=f"https://{account_name}.blob.core.windows.net/{container_name}/{quote(file_name)}?{file_sas}" 
-        text = analyze_read(formUrl,verbose=True)
-        context=''
-        for k, t in enumerate(text):
-            context = context+t # for future use in prompt
-        with open(context_file_name, 'w') as f:
-            f.write(context)  # text has to be string not a list
-        colorprint(f"Writing context file {context_file_name}",'44')
+    # Form Recognizer results are cached by blob content (see formrecognizer.analyze_document),
+    # the context file is only written for inspection.
+    text = analyze_read(formUrl,verbose=True,cache_key=cache_key)
+    context=''.join(text)
+    with open(context_file_name, 'w') as f:
+        f.write(context)  # text has to be string not a list
+    colorprint(f"Writing context file {context_file_name}",'44')
     
-    return(context)
+    # the page buckets, joined into the full context or used as retrieval chunks
+    return(text)
 
-def get_openAI_response(context='lores ipsum',question=['tl;dr'],model='text-davinci-003',temperature=1,tokens_response=15,restart_sequence=15):
+def get_openAI_response(context='lores ipsum',question=['tl;dr'],model='text-davinci-003',temperature=1,tokens_response=15,restart_sequence=15,single_call=False,contexts=None):
+    # contexts: one context per field (see get_scoped_contexts) instead of the whole document for all of them
     question_text=[]
     response_text=[]
     instruction = question[0]
     colorprint(instruction,'20')
-    for q in question[1:]:
-        prompt = f"{context}{restart_sequence}{instruction}{''+q}"
-        try:
-            response = openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=tokens_response,
-                top_p=0.5,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-        except:
-            time.sleep(7)
-            response = openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=tokens_response,
-                top_p=0.5,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-        r=response['choices'][0]['text'].strip(' \n\:?')
+    if single_call and contexts is None:
+        answers = ask_all_fields(context, instruction, question[1:], model=model, temperature=temperature, tokens_response=tokens_response, restart_sequence=restart_sequence)
+    else:
+        answers = [None] * len(question[1:])
+    for i, (q, r) in enumerate(zip(question[1:], answers)):
+        if r is None:
+            prompt = f"{context if contexts is None else contexts[i]}{restart_sequence}{instruction}{''+q}"
+            r = complete_prompt(prompt, model=model, temperature=temperature, tokens_response=tokens_response)
         colorprint(q, '33', end=' ')
         colorprint(r,'22')
         response_text.append(r)
@@ -93,36 +77,61 @@ colorprint('THE QUESTION: ' + str(question), '44')
 colorprint('INITIALIZING OPENAI CONNECTION')
 initialize()
 
-df = pd.DataFrame(question[1:],columns =['Q'])
-
-colorprint('DISCOVERING ALL FILES IN THE BLOB STORAGE:')
-files_data = get_all_files()
-files_data = list(map(lambda x: {'filename': x['filename']}, files_data))
-for fd in files_data:
-        print(fd['filename'])
+if incremental_sync:
+    colorprint('DISCOVERING NEW OR CHANGED FILES IN THE BLOB STORAGE:')
+    manifest = BlobManifest()
+    files_data = map(lambda x: {'filename': x['filename'], 'cache_key': x['cache_key']}, iter_changed_files(manifest=manifest))
+else:
+    colorprint('DISCOVERING ALL FILES IN THE BLOB STORAGE:')
+    files_data = get_all_files()
+    files_data = list(map(lambda x: {'filename': x['filename'], 'cache_key': x['cache_key']}, files_data))
+    for fd in files_data:
+            print(fd['filename'])
 
-file_name = files_data[1]['filename']
-for file in files_data:
+def analyze_file(file):
     file_name=file['filename']
-    try:
-        file_name_root = os.path.splitext(file_name)[0] 
-        file_sas = generate_blob_sas(account_name, container_name, file_name, account_key= account_key, permission='r', expiry=datetime.utcnow() + timedelta(hours=1))
-        formUrl=f"https://{account_name}.blob.core.windows.net/{container_name}/{quote(file_name)}?{file_sas}" 
+    formUrl=get_blob_sas_url(file_name)
+    return get_context(formUrl,file_name,file['cache_key'])
+
+def answer_file(file, chunks):
+    file_name_root = os.path.splitext(file['filename'])[0] 
+    context = ''.join(chunks)
+    # long documents only send each field its most relevant chunks, short ones keep the full context
+    contexts = get_scoped_contexts(chunks, question[1:], model=model) if retrieval else None
+    colorprint("QUERING OPENAI USING EXTRACTED TEXT AS CONTEXT:" if contexts is None else "QUERING OPENAI USING THE RELEVANT CHUNKS AS CONTEXT:")
+    openAIresponse = get_openAI_response(context,question,model=model,temperature =0.0, tokens_response=15,restart_sequence='\n\n',single_call=single_call,contexts=contexts)
+    response_text = openAIresponse[1]
 
+    response_file_name =os.path.join('data','response_'+file_name_root+'.txt')
+    with open(response_file_name, 'w') as f2:
+        f2.write(str(response_text))  
+    return response_text
 
-        context = get_context(formUrl,file_name)
-        colorprint("QUERING OPENAI USING EXTRACTED TEXT AS CONTEXT:")
-        openAIresponse = get_openAI_response(context,question,model=model,temperature =0.0, tokens_response=15,restart_sequence='\n\n')
-        question_text = openAIresponse[0]
-        response_text = openAIresponse[1]
+def pending_files(files):
+    # documents already answered (same blob version, all the fields) in a previous run are skipped
+    for file in files:
+        if sink.is_done(file):
+            colorprint(f"Skipping {file['filename']}, already in {sink.path}", '44')
+            if incremental_sync:
+                manifest.set_state(file['filename'], 'done')
+            continue
+        yield file
 
-        response_file_name =os.path.join('data','response_'+file_name_root+'.txt')
-        with open(response_file_name, 'w') as f2:
-            f2.write(str(response_text))  
-        df[file_name_root]=response_text
-    except:
-        colorprint("File couldn't be processed",'9')
+def on_result(file, response_text):
+    sink.write(file, response_text)
+    if incremental_sync:
+        manifest.set_state(file['filename'], 'done')
 
+def on_error(file, e):
+    if incremental_sync:
+        manifest.set_state(file['filename'], 'failed')
 
-df.to_csv(f"data/result.csv")
+# the answers are appended to the sink as each document finishes, result.csv is built from it at the end
+with ResultSink(question[1:]) as sink:
+    run_batch(pending_files(files_data), analyze_file, answer_file, on_result=on_result, on_error=on_error)
+colorprint(f"Completion cache: {get_completion_cache().stats()}", '44')
+colorprint(f"OpenAI quota utilization: {get_scheduler().utilization()}", '44')
+colorprint(f"Stages: {metrics.stats()}", '44')
+write_metrics()
+df = sink.to_csv(f"data/result.csv")
 print(df)
@@ -4,10 +4,16 @@ from azure.storage.blob import BlobServiceClient, generate_blob_sas
 from datetime import datetime, timedelta
 import os,json
 from dotenv import load_dotenv
-from utilities.azureblobstorage import get_all_files
+from utilities.azureblobstorage import get_all_files, iter_changed_files, BlobManifest, get_blob_sas_url
 from utilities.utils import initialize, get_openAI_response
 from utilities.utils import colorprint
 from utilities.formrecognizer import analyze_read,analyze_general_documents
+from utilities.pipeline import run_batch
+from utilities.resultsink import ResultSink
+from utilities.completioncache import get_completion_cache
+from utilities.openaischeduler import get_scheduler
+from utilities.instrumentation import start_metrics_server, write_metrics, metrics
+from utilities.cascade import cascade_stats
 from urllib.parse import *
 import tiktoken
 from openai.embeddings_utils import get_embedding, cosine_similarity
@@ -22,16 +28,17 @@ account_key = os.environ['BLOB_ACCOUNT_KEY']
 connect_str = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
 container_name = os.environ['BLOB_CONTAINER_NAME']
 model = os.environ['OPENAI_QnA_MODEL'] #e.g. 'text-davinci-003' deployment
+single_call = os.getenv('OPENAI_SINGLE_CALL', 'false').lower() == 'true' # ask for all fields in one completion
+incremental_sync = os.getenv('INCREMENTAL_SYNC', 'false').lower() == 'true' # only process new or changed blobs
 os.makedirs('data', mode = 0o777, exist_ok = True) 
+start_metrics_server() # METRICS_PORT
+os.makedirs('context_data', mode = 0o777, exist_ok = True) 
 
-def get_context_general(formUrl,file_name):
-    file_name_root = os.path.splitext(file_name)[0] 
-    context_file_name = os.path.join('data','context_'+file_name_root+'.txt') 
+def get_context_general(formUrl,file_name,cache_key=None):
     colorprint('ANALYZING FILE : '+ file_name)
-    colorprint('Sending the document to Form Recognizer to extract content')
     #file_sas = generate_blob_sas(account_name, container_name, file_name, account_key= account_key, permission='r', expiry=datetime.utcnow() + timedelta(hours=1))
     #formUrl=f"https://{account_name}.blob.core.windows.net/{container_name}/{quote(file_name)}?{file_sas}" 
-    analysis_result=analyze_general_documents(formUrl)
+    analysis_result=analyze_general_documents(formUrl,cache_key=cache_key)
     kv_text = analysis_result[0]
     raw_text_lines=analysis_result[1]
     raw_text_words=analysis_result[2]
@@ -63,55 +70,79 @@ with open('question.txt') as f:
 f.close()
 colorprint('INITIALIZING OPENAI CONNECTION')
 initialize()
-df = pd.DataFrame(question[1:],columns =['Q'])
-
-colorprint('DISCOVERING ALL FILES IN THE BLOB STORAGE:')
-files_data = get_all_files()
-files_data = list(map(lambda x: {'filename': x['filename']}, files_data))
-for fd in files_data:
-        print(fd['filename'])
+if incremental_sync:
+    colorprint('DISCOVERING NEW OR CHANGED FILES IN THE BLOB STORAGE:')
+    manifest = BlobManifest()
+    files_data = map(lambda x: {'filename': x['filename'], 'cache_key': x['cache_key']}, iter_changed_files(manifest=manifest))
+else:
+    colorprint('DISCOVERING ALL FILES IN THE BLOB STORAGE:')
+    files_data = get_all_files()
+    files_data = list(map(lambda x: {'filename': x['filename'], 'cache_key': x['cache_key']}, files_data))
+    for fd in files_data:
+            print(fd['filename'])
 
 
-for file in files_data:
+def analyze_file(file):
     file_name=file['filename']
     colorprint(f"EXTRACTING TEXT CONTENT FILE: {file_name}")
     file_name_root = os.path.splitext(file_name)[0] 
     context_file_name = os.path.join('context_data','context_'+file_name_root+'.txt') 
     context2_file_name = os.path.join('context_data','context2_'+file_name_root+'.txt') 
     
-    try: 
-        with open(context_file_name) as f:
-            used_context =f.read()
-            colorprint(f"Found file {context_file_name} with extracted content for context.      ------>     Reading file, NOT sending document to Form Recognizer.",'87')
-        with open(context2_file_name) as f:
-            secondary_context =f.read()
-            colorprint(f"Found file {context2_file_name} with extracted content for context.     ------>     Reading file, NOT sending document to Form Recognizer.",'87')
+    # Form Recognizer results are cached by blob content (see formrecognizer.analyze_document),
+    # the context files are only written for inspection.
+    formUrl=get_blob_sas_url(file_name)
 
-    except:
-        file_sas = generate_blob_sas(account_name, container_name, file_name, account_key= account_key, permission='r', expiry=datetime.utcnow() + timedelta(hours=1))
-        formUrl=f"https://{account_name}.blob.core.windows.net/{container_name}/{quote(file_name)}?{file_sas}" 
-    
-        context = get_context_general(formUrl,file_name)
-        used_context=context[0]
-        secondary_context=context[1]
-        with open(context_file_name, 'w') as f:
-            f.write(used_context)  # text has to be string not a list
-            colorprint(f"Writing context file {context_file_name}",'44')
-        with open(context2_file_name, 'w') as f:
-            f.write(secondary_context)  # text has to be string not a list
-            colorprint(f"Writing context file {context2_file_name}",'44')
+    context = get_context_general(formUrl,file_name,file['cache_key'])
+    used_context=context[0]
+    secondary_context=context[1]
+    with open(context_file_name, 'w') as f:
+        f.write(used_context)  # text has to be string not a list
+        colorprint(f"Writing context file {context_file_name}",'44')
+    with open(context2_file_name, 'w') as f:
+        f.write(secondary_context)  # text has to be string not a list
+        colorprint(f"Writing context file {context2_file_name}",'44')
+    return used_context, secondary_context
+
+def answer_file(file, context):
+    used_context, secondary_context = context
+    file_name_root = os.path.splitext(file['filename'])[0] 
     colorprint('OPENAI QUERY')
-    try:
-        openAIresponse = get_openAI_response(context=used_context,secondary_context=str(secondary_context),question=question,model=model,temperature =0.0, tokens_response=15,restart_sequence='\n\n')
-        question_text = openAIresponse[0]
-        response_text = openAIresponse[1]
+    openAIresponse = get_openAI_response(context=used_context,secondary_context=str(secondary_context),question=question,model=model,temperature =0.0, tokens_response=15,restart_sequence='\n\n',single_call=single_call)
+    response_text = openAIresponse[1]
+
+    response_file_name =os.path.join('data','response_'+file_name_root+'.txt')
+    with open(response_file_name, 'w') as f2:
+        f2.write(str(response_text))  
+    return response_text
+
+def pending_files(files):
+    # documents already answered (same blob version, all the fields) in a previous run are skipped
+    for file in files:
+        if sink.is_done(file):
+            colorprint(f"Skipping {file['filename']}, already in {sink.path}", '44')
+            if incremental_sync:
+                manifest.set_state(file['filename'], 'done')
+            continue
+        yield file
+
+def on_result(file, response_text):
+    sink.write(file, response_text)
+    if incremental_sync:
+        manifest.set_state(file['filename'], 'done')
+
+def on_error(file, e):
+    if incremental_sync:
+        manifest.set_state(file['filename'], 'failed')
 
-        response_file_name =os.path.join('data','response_'+file_name_root+'.txt')
-        with open(response_file_name, 'w') as f2:
-            f2.write(str(response_text))  
-        df[file_name_root]=response_text
-    except:
-        colorprint("File couldn't be processed",'9')
+# the answers are appended to the sink as each document finishes, result.csv is built from it at the end
+with ResultSink(question[1:]) as sink:
+    run_batch(pending_files(files_data), analyze_file, answer_file, on_result=on_result, on_error=on_error)
+colorprint(f"Completion cache: {get_completion_cache().stats()}", '44')
+colorprint(f"OpenAI quota utilization: {get_scheduler().utilization()}", '44')
+colorprint(f"Stages: {metrics.stats()}", '44')
+write_metrics()
+colorprint(f"Cascade tiers: {cascade_stats.stats()}", '44')
+df = sink.to_csv(f"data/result.csv")
 print('--------------------')
 print(df)
-df.to_csv(f"data/result.csv")
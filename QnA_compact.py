@@ -4,10 +4,11 @@ from azure.storage.blob import BlobServiceClient, generate_blob_sas
 from datetime import datetime, timedelta
 import os,json
 from dotenv import load_dotenv
-from utilities.azureblobstorage import get_all_files
+from utilities.azureblobstorage import get_container_client, get_blob_properties, get_cache_key, get_blob_sas_url
 #from utilities.utils import convert_file_and_add_embeddings,  add_embeddings
 from utilities.utils import initialize
 from utilities.utils import colorprint
+from utilities.completioncache import cached_completion
 from utilities.formrecognizer import analyze_read
 #from urllib.request import urlopen
 from urllib.parse import *
@@ -44,8 +45,8 @@ initialize()
 
 os.makedirs('data', mode = 0o777, exist_ok = True) 
 
-files_data = get_all_files()
-files_data = list(map(lambda x: {'filename': x['filename']}, files_data))
+# only the names are listed, the cache key is read from the properties of the one blob analyzed below
+files_data = [{'filename': blob.name} for blob in get_container_client().list_blobs() if not blob.name.startswith('converted/')]
 
 colorprint('DISCOVERING ALL FILES IN THE BLOB STORAGE:')
 
@@ -56,21 +57,14 @@ for fd in files_data:
 file_name = files_data[10]['filename']
 file_name_root = os.path.splitext(file_name)[0]
 colorprint('ANALYZING FILE : '+ file_name) 
-try: 
-    with open(os.path.join('data',file_name_root+'_fr_context.txt')) as f:
-        context =f.read()
-        colorprint(f"Found file {file_name_root}_fr_context.txt with extracted content for context. \nReading file, NOT sending document to Form Recognizer.",'44')
-except:
-    colorprint('Sending the document to Form Recognizer to extract content')
-    file_sas = generate_blob_sas(account_name, container_name, file_name, account_key= account_key, permission='r', expiry=datetime.utcnow() + timedelta(hours=1))
-    formUrl=f"https://{account_name}.blob.core.windows.net/{container_name}/{quote(file_name)}?{file_sas}" 
-    text = analyze_read(formUrl,verbose=True)
-    context=''
-    for k, t in enumerate(text):
-        context = context+t # for future use in prompt
-    with open(os.path.join('data',file_name_root+'_fr_context.txt'), 'w') as f:
-        f.write(context)  # text has to be string not a list
-    colorprint(f"Writing file {file_name_root}_fr_context.txt",'44')
+# Form Recognizer results are cached by blob content (see formrecognizer.analyze_document), so a changed
+# blob with the same name is analyzed again; the context file is only written for inspection.
+formUrl=get_blob_sas_url(file_name)
+text = analyze_read(formUrl,verbose=True,cache_key=get_cache_key(get_blob_properties(file_name)))
+context=''.join(text)
+with open(os.path.join('data',file_name_root+'_fr_context.txt'), 'w') as f:
+    f.write(context)  # text has to be string not a list
+colorprint(f"Writing file {file_name_root}_fr_context.txt",'44')
 colorprint("QUERING OPENAI USING EXTRACTED TEXT AS CONTEXT:")
 question_text=[]
 response_text=[]
@@ -78,30 +72,17 @@ instruction = question[0]
 colorprint(instruction,'20')
 for q in question[1:]:
     prompt = f"{context}{restart_sequence}{instruction}{''+q}"
-    try:
-        response = openai.Completion.create(
-            engine=model,
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=tokens_response,
-            top_p=1,
-            frequency_penalty=1,
-            presence_penalty=1,
-            stop=None
-        )
-    except:
-        time.sleep(5)
-        response = openai.Completion.create(
-            engine=model,
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=tokens_response,
-            top_p=1,
-            frequency_penalty=1,
-            presence_penalty=1,
-            stop=None
-        )
-    r=response['choices'][0]['text'].strip(' \n\:?')
+    response = cached_completion(
+        engine=model,
+        prompt=prompt,
+        temperature=temperature,
+        max_tokens=tokens_response,
+        top_p=1,
+        frequency_penalty=1,
+        presence_penalty=1,
+        stop=None
+    )
+    r=response['choices'][0]['text'].strip(' \n:?')
     colorprint(q, '33', end=' ')
     colorprint(r,'22')
     #print(q+': '+ r)
@@ -0,0 +1,65 @@
+import numpy as np
+from shapely.geometry import Polygon
+
+ROTATION_TOLERANCE = 0.5 # degrees, pages rotated more than this use exact polygon intersection
+
+
+""""
+ * convert polygons into one array
+ * @param polygons list of polygons, each 4 points with x/y or a flat list of 8 numbers
+ * @returns float array of shape (n, 4, 2)
+"""
+def polygon_array(polygons):
+    if len(polygons) == 0:
+        return np.empty((0, 4, 2))
+    if hasattr(polygons[0][0], 'x'):
+        return np.array([[(point.x, point.y) for point in polygon[:4]] for polygon in polygons], dtype=float)
+    return np.array([polygon[:8] for polygon in polygons], dtype=float).reshape(-1, 4, 2)
+
+""""
+ * checks if the page content is rotated, then axis-aligned boxes are not a good approximation
+ * @param page a page object in Ocrtoy result or its PageLayout
+ * @returns is rotated or not
+"""
+def is_rotated(page):
+    return abs(getattr(page, 'angle', 0) or 0) > ROTATION_TOLERANCE
+
+""""
+ * calculate for every quad the part of the hull area it covers, using axis-aligned bounding boxes
+ * @param hull polygon of the hull
+ * @param quads array of shape (n, 4, 2)
+ * @returns array of n ratios (intersection area / hull area)
+"""
+def overlap_ratios(hull, quads):
+    hull_box = polygon_array([hull])[0]
+    hull_min = hull_box.min(axis=0)
+    hull_max = hull_box.max(axis=0)
+    hull_area = np.prod(hull_max - hull_min)
+    if len(quads) == 0 or hull_area <= 0:
+        return np.zeros(len(quads))
+    sides = np.clip(np.minimum(quads.max(axis=1), hull_max) - np.maximum(quads.min(axis=1), hull_min), 0, None)
+    return sides.prod(axis=1) / hull_area
+
+""""
+ * calculate the same ratios with exact polygon intersection, for rotated pages
+ * @param hull polygon of the hull
+ * @param quads array of shape (n, 4, 2)
+ * @returns array of n ratios (intersection area / hull area)
+"""
+def exact_overlap_ratios(hull, quads):
+    hull_polygon = Polygon(polygon_array([hull])[0])
+    if len(quads) == 0 or hull_polygon.area <= 0:
+        return np.zeros(len(quads))
+    return np.array([hull_polygon.intersection(Polygon(quad)).area / hull_polygon.area for quad in quads])
+
+""""
+ * select the quads covering at least `percent` percent of the hull area
+ * @param hull polygon of the hull
+ * @param quads array of shape (n, 4, 2)
+ * @param percent threshold in percent
+ * @param rotated use exact polygon intersection
+ * @returns boolean array of n
+"""
+def overlapping_mask(hull, quads, percent, rotated=False):
+    ratios = exact_overlap_ratios(hull, quads) if rotated else overlap_ratios(hull, quads)
+    return ratios * 100 >= percent
@@ -0,0 +1,139 @@
+from enum import Enum
+import numpy as np
+from layoutgeometry import polygon_array
+
+
+class ElementType(Enum):
+    word = 1
+    checkbox = 2
+
+class ElementWeight(Enum):
+    Word = 1
+    Checkbox = 1.1
+
+class Coordinates:
+    __slots__ = ('X', 'Y')
+    def __init__(self, X: float, Y: float):
+        self.X = X
+        self.Y = Y
+
+class VerticalInterval:
+    __slots__ = ('yMax', 'yMin')
+    def __init__(self, yMax: float, yMin: float):
+        self.yMax = yMax
+        self.yMin = yMin
+
+class ElementSpan:
+    __slots__ = ('offset', 'length')
+    def __init__(self, offset: int, length: int):
+        self.offset = offset
+        self.length = length
+
+
+""""
+ * words and selection marks of a page as struct-of-arrays columns, computed once per page.
+ * elements 0..word_count-1 are the words, the rest are the selection marks, in page order.
+ * @param page a page object in Ocrtoy result
+"""
+class PageLayout:
+    __slots__ = ('page_number', 'angle', 'word_count', 'polygons', 'centers', 'y_intervals',
+                 'span_offsets', 'span_lengths', 'types', 'contents',
+                 'word_order', 'word_offsets', 'selection_order', 'selection_offsets',
+                 'element_types', 'center_coordinates', 'vertical_intervals', 'element_spans')
+
+    def __init__(self, page):
+        words = page.words or []
+        selection_marks = page.selection_marks or []
+        self.page_number = page.page_number
+        self.angle = getattr(page, 'angle', 0) or 0
+        self.word_count = len(words)
+
+        self.polygons = polygon_array([w.polygon for w in words] + [s.polygon for s in selection_marks])
+        self.centers = (self.polygons[:, 0, :] + self.polygons[:, 2, :]) / 2
+        self.y_intervals = np.stack([self.polygons[:, :, 1].min(axis=1), self.polygons[:, :, 1].max(axis=1)], axis=1)
+        self.span_offsets = np.array([e.span.offset for e in words] + [s.span.offset for s in selection_marks], dtype=np.int64)
+        self.span_lengths = np.array([e.span.length for e in words] + [s.span.length for s in selection_marks], dtype=np.int64)
+        self.types = np.array([ElementType.word.value] * len(words) + [ElementType.checkbox.value] * len(selection_marks), dtype=np.int8)
+        self.contents = [w.content for w in words] + [s.state for s in selection_marks]
+
+        # element indexes sorted by span offset, for span lookups
+        self.word_order = np.argsort(self.span_offsets[:self.word_count], kind='stable')
+        self.word_offsets = self.span_offsets[self.word_order]
+        self.selection_order = self.word_count + np.argsort(self.span_offsets[self.word_count:], kind='stable')
+        self.selection_offsets = self.span_offsets[self.selection_order]
+
+        # the values BaseElement hands out, built once per page rather than from the arrays at every access
+        self.element_types = [ElementType(t) for t in self.types.tolist()]
+        self.center_coordinates = [Coordinates(X, Y) for X, Y in self.centers.tolist()]
+        self.vertical_intervals = [VerticalInterval(yMax, yMin) for yMin, yMax in self.y_intervals.tolist()]
+        self.element_spans = [ElementSpan(offset, length) for offset, length in zip(self.span_offsets.tolist(), self.span_lengths.tolist())]
+
+    def __len__(self):
+        return len(self.types)
+
+    def words_in_span(self, start, end):
+        return self._in_span(self.word_order, self.word_offsets, start, end)
+
+    def selections_in_span(self, start, end):
+        return self._in_span(self.selection_order, self.selection_offsets, start, end)
+
+    def _in_span(self, order, offsets, start, end):
+        candidates = order[np.searchsorted(offsets, start, 'left'):np.searchsorted(offsets, end, 'right')]
+        return candidates[self.span_offsets[candidates] + self.span_lengths[candidates] <= end]
+
+    def selection_indexes(self):
+        return np.arange(self.word_count, len(self))
+
+    def elements(self, indexes):
+        return [BaseElement(self, int(i)) for i in indexes]
+
+
+""""
+ * lightweight view of one element of a PageLayout
+"""
+class BaseElement:
+    __slots__ = ('layout', 'index')
+
+    def __init__(self, layout: PageLayout, index: int):
+        self.layout = layout
+        self.index = index
+
+    @property
+    def type(self):
+        return self.layout.element_types[self.index]
+
+    @property
+    def weight(self):
+        return ElementWeight.Word.value if self.layout.element_types[self.index] is ElementType.word else ElementWeight.Checkbox.value
+
+    @property
+    def content(self):
+        return self.layout.contents[self.index]
+
+    @property
+    def centerCoordinates(self):
+        return self.layout.center_coordinates[self.index]
+
+    @property
+    def verticalInterval(self):
+        return self.layout.vertical_intervals[self.index]
+
+    @property
+    def span(self):
+        return self.layout.element_spans[self.index]
+
+    @property
+    def polygon(self):
+        return self.layout.polygons[self.index]
+
+
+""""
+ * calculate the total polygon of several elements.
+ * @param elements BaseElement views
+ * @returns the total polygon
+"""
+def get_hull(elements):
+    points = np.concatenate([ele.polygon for ele in elements])
+    min_x, min_y = points.min(axis=0)
+    max_x, max_y = points.max(axis=0)
+    return [min_x, min_y, max_x, min_y, max_x, max_y, min_x, max_y]
@@ -1,46 +1,15 @@
-from enum import Enum
 from shapely.geometry import Polygon
-import math
+from azure.ai.formrecognizer import AnalyzeResult
+import math, json
+from bisect import bisect_left, bisect_right, insort
 from itertools import groupby
+from layoutgeometry import is_rotated, overlapping_mask
+from layoutmodel import ElementType, ElementWeight, Coordinates, VerticalInterval, ElementSpan, BaseElement, PageLayout, get_hull
 
 
 
 DEF_PERCENT = 0.9
 
-class ElementType(Enum):
-    word = 1
-    checkbox = 2
-
-class ElementWeight(Enum):
-    Word = 1
-    Checkbox = 1.1
-
-class Coordinates:
-    def __init__(self, X: int, Y: int):
-        self.X = X
-        self.Y = Y
-
-class VerticalInterval:
-    def __init__(self, yMax: int, yMin: int):
-        self.yMax = yMax
-        self.yMin = yMin
-
-class ElementSpan:
-    def __init__(self, offset: int, length: int):
-        self.offset = offset
-        self.length = length
-
-class BaseElement:
-    def __init__(self, type: ElementType, weight: ElementWeight, content: str,
-                 centerCoordinates: Coordinates, verticalInterval: VerticalInterval,
-                 polygon: list[int]):
-        self.type = type
-        self.weight = weight
-        self.content = content
-        self.centerCoordinates = centerCoordinates
-        self.verticalInterval = verticalInterval
-        self.polygon = polygon
-
 
 """"
  * Analysis each paragraph and parse it into JSX.Element
@@ -50,19 +19,45 @@ class BaseElement:
 def renderPage(result):
     paragraphs = result.paragraphs
     tables = result.tables
+    cellTableIndex = build_cell_table_index(tables)
     pageContentArr = []
+    contentPolygons = set()
     for p in paragraphs:
-        table = next((table for table in tables if any(cell.bounding_regions[0].polygon == p.bounding_regions[0].polygon for cell in table.cells)), None)
+        table = cellTableIndex.get(polygon_key(p.bounding_regions[0].polygon))
         if table:
             table.type = "table"
-            if not any(content.bounding_regions[0].polygon == table.bounding_regions[0].polygon for content in pageContentArr):
+            tableKey = polygon_key(table.bounding_regions[0].polygon)
+            if tableKey not in contentPolygons:
                 pageContentArr.append(table)
+                contentPolygons.add(tableKey)
         else:
             p.type = "text"
             pageContentArr.append(p)
+            contentPolygons.add(polygon_key(p.bounding_regions[0].polygon))
     return renderParagraphs(pageContentArr, result)
 
 
+""""
+ * hashable key of a polygon, two polygons have the same key when they are equal
+ * @param polygon object polygon
+ * @returns tuple of the polygon points
+"""
+def polygon_key(polygon):
+    return tuple((point.x, point.y) for point in polygon)
+
+""""
+ * index the tables by the polygons of their cells, built once per analyzeResult
+ * @param tables the tables of the analyzeResult
+ * @returns dict from cell polygon key to the first table containing that cell
+"""
+def build_cell_table_index(tables):
+    index = {}
+    for table in tables:
+        for cell in table.cells:
+            index.setdefault(polygon_key(cell.bounding_regions[0].polygon), table)
+    return index
+
+
 
 """"
  * parse the content into JSX.Element by each category
@@ -75,6 +70,10 @@ def renderParagraphs(contentArr, result):
     group_paragraphs = []
     for index, content in enumerate(contentArr):
         if content.type == "text":
+            # text paragraphs of different pages are rendered separately
+            if temp and get_element_page_numbers(content, result)[0] != get_element_page_numbers(temp[-1], result)[-1]:
+                group_paragraphs.append(temp)
+                temp = []
             temp.append(content)
         else:
             if len(temp) > 0:
@@ -124,41 +123,23 @@ def render_table(table, result):
 """
 def render_paragraph(paragraphs, result):
     elements = []
-    def_page = result.pages[0]
     words = [get_all_words_in_paragraph(paragraph, result) for paragraph in paragraphs]
     words = [v for sublist in words for v in sublist]
-    words_polygon = get_polygon([word['polygon'] for word in words])
-    selections_to_sort = [
-        {
-            'type': ElementType.checkbox,
-            'content': select.state,
-            'center_coordinates': calc_geometric_center_coordinates(select.polygon),
-            'vertical_interval': pick_vertical_interval(select.polygon),
-            'weight': 1.1,
-            'polygon': select.polygon,
-        }
-        for select in def_page.selection_marks
-        if intersection_in_percent(words_polygon, select.polygon)
-    ]
-    elements = output_html_by_base_elements(words + selections_to_sort)
+    # words of different pages are never on the same line, a paragraph spanning pages is rendered page by page
+    words_by_page = {}
+    for word in words:
+        words_by_page.setdefault(word.layout.page_number, []).append(word)
+    for page_number in sorted(words_by_page):
+        layout = get_page_layout(result, page_number)
+        page_words = words_by_page[page_number]
+        words_polygon = get_hull(page_words)
+        selection_indexes = layout.selection_indexes()
+        selected = overlapping_mask(words_polygon, layout.polygons[selection_indexes], DEF_PERCENT, is_rotated(layout))
+        selections_to_sort = layout.elements(selection_indexes[selected])
+        elements += output_html_by_base_elements(page_words + selections_to_sort)
     return elements
 
 
-""""
- * calculate the total polygon of several words.
- * @param polygons the array of word's polygon
- * @returns the total polygon
-"""
-def get_polygon(polygons):
-  x = [p[0].x for p in polygons] + [p[1].x for p in polygons] + [p[2].x for p in polygons] + [p[3].x for p in polygons]
-  y = [p[0].y for p in polygons] + [p[1].y for p in polygons] + [p[2].y for p in polygons] + [p[3].y for p in polygons]
-  min_x = min(x)
-  max_x = max(x)
-  min_y = min(y)
-  max_y = max(y)
-
-  return [min_x, min_y, max_x, min_y, max_x, max_y, min_x, max_y]
-
 """"
  * parse the table cell object into JSX.Element
  * @param cellObj cell object in Ocrtoy result
@@ -175,6 +156,41 @@ def parse_table_cell_content_to_html(cell_obj, result):
     return elements
 
 
+""""
+ * get the layout model of a page, built once per page of the analyzeResult
+ * @param result the analyzeResult object in Ocrtoy json.
+ * @param page_number page number
+ * @returns PageLayout of the page
+"""
+def get_page_layout(result, page_number):
+    if not hasattr(result, "page_layouts"):
+        result.page_layouts = {}
+    if page_number not in result.page_layouts:
+        result.page_layouts[page_number] = PageLayout(get_page(result, page_number))
+    return result.page_layouts[page_number]
+
+""""
+ * get the page object by its page number
+ * @param result the analyzeResult object in Ocrtoy json.
+ * @param page_number page number
+ * @returns page object
+"""
+def get_page(result, page_number):
+    if 0 < page_number <= len(result.pages) and result.pages[page_number - 1].page_number == page_number:
+        return result.pages[page_number - 1]
+    return next(page for page in result.pages if page.page_number == page_number)
+
+""""
+ * get the page numbers an element is on, all the pages when the element has no bounding regions
+ * @param element paragraph or cell object in Ocrtoy result
+ * @param result the analyzeResult object in Ocrtoy json.
+ * @returns page numbers
+"""
+def get_element_page_numbers(element, result):
+    if getattr(element, "bounding_regions", None):
+        return sorted({region.page_number for region in element.bounding_regions})
+    return [page.page_number for page in result.pages]
+
 """"
  * get all the selection box from cell object
  * @param cellObj cell object in Ocrtoy result
@@ -182,20 +198,14 @@ def parse_table_cell_content_to_html(cell_obj, result):
  * @returns selection boxes elements
 """
 def get_all_selections_in_cell(cell_obj, result):
-    selections = []
-    def_page = result.pages[0]
-
-    if def_page.selection_marks:
-        selections = [select for select in def_page.selection_marks if any(span for span in cell_obj.spans if span.offset <= select.span.offset and select.span.offset + select.span.length <= span.offset + span.length)]
-
-    selections_to_sort = [{
-        'type': ElementType.checkbox,
-        'content': select.state,
-        'center_coordinates': calc_geometric_center_coordinates(select.polygon),
-        'vertical_interval': pick_vertical_interval(select.polygon),
-        'polygon': select.polygon,
-        'weight': ElementWeight.Checkbox
-    } for select in selections]
+    selections_to_sort = []
+    if result.pages and cell_obj.spans:
+        for page_number in get_element_page_numbers(cell_obj, result):
+            layout = get_page_layout(result, page_number)
+            indexes = set()
+            for span in cell_obj.spans:
+                indexes.update(layout.selections_in_span(span.offset, span.offset + span.length).tolist())
+            selections_to_sort += layout.elements(sorted(indexes, key=lambda i: layout.span_offsets[i]))
 
     return selections_to_sort
 
@@ -207,25 +217,14 @@ def get_all_selections_in_cell(cell_obj, result):
 """
 def get_all_words_in_paragraph(para, result):
     all_words = []
-    if para and para.spans and result.pages and result.pages[0]:
-        def_page = result.pages[0]
-        if para.spans and len(para.spans) > 0:
-            para_span = para.spans[0]
-            cell_content_start_index = para_span.offset
-            cell_content_end_index = para_span.offset + para_span.length
-
-            all_words = [{ 
-                    "type": ElementType.word,
-                    "weight": ElementWeight.Word,
-                    "content": w.content,
-                    "center_coordinates": calc_geometric_center_coordinates(w.polygon),
-                    "vertical_interval": pick_vertical_interval(w.polygon),
-                    "polygon": w.polygon
-                }
-                for w in def_page.words
-                if cell_content_start_index <= w.span.offset
-                and w.span.offset + w.span.length <= cell_content_end_index
-            ]
+    if para and para.spans and result.pages:
+        para_span = para.spans[0]
+        cell_content_start_index = para_span.offset
+        cell_content_end_index = para_span.offset + para_span.length
+
+        for page_number in get_element_page_numbers(para, result):
+            layout = get_page_layout(result, page_number)
+            all_words += layout.elements(layout.words_in_span(cell_content_start_index, cell_content_end_index))
     return all_words
 
 """"
@@ -236,10 +235,10 @@ def get_all_words_in_paragraph(para, result):
 def renderHtmlElement(elementArr):
     transformedEleArr = []
     for ele in elementArr:
-        if ele['type'] == ElementType.word:
-            transformedEleArr.append(ele['content'])
-        elif ele['type'] == ElementType.checkbox:
-            if ele['content'] == "selected":
+        if ele.type == ElementType.word:
+            transformedEleArr.append(ele.content)
+        elif ele.type == ElementType.checkbox:
+            if ele.content == "selected":
                 transformedEleArr.append(f'<input type="checkbox" checked="true"></input>')
             else: 
                 transformedEleArr.append(f'<input type="checkbox"></input>')
@@ -266,33 +265,75 @@ def renderHtmlElement(elementArr):
  * @returns sorted JSX.Element array
 """
 def output_html_by_base_elements(baseElements):
-    groupMap = {}
-    for ele in baseElements:
-        findSameLine = False
-        for yKey, eleArr in groupMap.items():
-            lastElement = eleArr[-1]
-            isSameLine = check_vertical_interval_intersection_in_percent(
-                lastElement['vertical_interval'],
-                ele['vertical_interval'],
-                0.7
-            )
-            if isSameLine:
-                eleArr.append(ele)
-                groupMap[yKey] = eleArr
-                findSameLine = True
-                break
-        if not findSameLine:
-            groupMap[(ele['vertical_interval']['yMax'] + ele['vertical_interval']['yMin']) / 2] = [ele]
-
-    ySortedElementsArr = sorted(groupMap.items(), key=lambda x: x[0])
+    ySortedElementsArr = cluster_lines(baseElements, 0.7)
 
     htmlElements = []
     for _, eleArr in ySortedElementsArr:
-        xSortedElements = sorted(eleArr, key=lambda x: x['center_coordinates']['X'] if x['center_coordinates']['X'] != 0 else x['weight'], reverse=True)
+        xSortedElements = sorted(eleArr, key=lambda x: x.centerCoordinates.X or x.weight, reverse=True)
         if len(ySortedElementsArr) == 1:
             htmlElements.append(renderHtmlElement(xSortedElements))
         else:
             htmlElements.append("<p>{}</p>".format(renderHtmlElement(xSortedElements)))
+    return htmlElements
+
+
+""""
+ * group the base elements into lines, same grouping as comparing every element with the last element of
+ * every line: elements are taken in input order and join the first line (in creation order) whose last
+ * element overlaps them vertically over the threshold, otherwise they start a new line.
+ * this is the sort-and-sweep, with the sorted active set being the last element of each line: sorting the
+ * elements themselves by center would change which line an element joins when it overlaps several, and so
+ * the reading order. an element can only pass the threshold against an interval it intersects, and a last
+ * element of half height h intersects [yMin, yMax] only if its center is within [yMin - h, yMax + h].
+ * the last elements are kept sorted by center in classes of half heights under 2**k, so each class is
+ * searched with two bisects over [yMin - 2**(k+1), yMax + 2**(k+1)] (twice the bound, as a margin), which
+ * returns every line that can match and keeps a tall element from widening the window of the others.
+ * the candidates are then checked in creation order, as before; test_render_html compares both groupings.
+ * @param baseElements
+ * @param threshold_in_percent vertical overlap needed to be on the same line
+ * @returns [yKey, elements] of each line, sorted by yKey (center of the first element of the line)
+"""
+def cluster_lines(baseElements, threshold_in_percent):
+    lines = []
+    lastIntervals = []
+    classes = {} # height class: sorted [(center of the last element, line index)]
+    for ele in baseElements:
+        interval = ele.verticalInterval
+        candidates = []
+        for heightClass, lastCenters in classes.items():
+            # a last element of this class intersecting the interval has its center in this window (with a margin)
+            halfHeight = math.ldexp(1, heightClass + 1)
+            start = bisect_left(lastCenters, (interval.yMin - halfHeight, -1))
+            end = bisect_right(lastCenters, (interval.yMax + halfHeight, len(lines)))
+            candidates += [lineIndex for _, lineIndex in lastCenters[start:end]]
+        for lineIndex in sorted(candidates):
+            if check_vertical_interval_intersection_in_percent(lastIntervals[lineIndex], interval, threshold_in_percent):
+                lines[lineIndex][1].append(ele)
+                remove_last_center(classes, lastIntervals[lineIndex], lineIndex)
+                lastIntervals[lineIndex] = interval
+                break
+        else:
+            lineIndex = len(lines)
+            lines.append(((interval.yMax + interval.yMin) / 2, [ele]))
+            lastIntervals.append(interval)
+        insort(classes.setdefault(height_class(interval), []), ((interval.yMax + interval.yMin) / 2, lineIndex))
+    return sorted(lines, key=lambda line: line[0])
+
+""""
+ * class of the half height of an interval, half heights of class k are under 2**k
+"""
+def height_class(interval):
+    return math.frexp((interval.yMax - interval.yMin) / 2)[1]
+
+""""
+ * remove the center of the last element of a line from its height class, before the line gets a new last element
+ * @param classes height class: sorted [(center of the last element, line index)]
+ * @param interval vertical interval of the current last element of the line
+ * @param lineIndex index of the line in the lines of cluster_lines
+"""
+def remove_last_center(classes, interval, lineIndex):
+    lastCenters = classes[height_class(interval)]
+    del lastCenters[bisect_left(lastCenters, ((interval.yMax + interval.yMin) / 2, lineIndex))]
 
 
 """"
@@ -335,26 +376,9 @@ def intersection_in_percent(polygon1, polygon2, percent=DEF_PERCENT):
     percent_overlap = (intersection_area / poly1.area) * 100
 
     # Check if the percent overlap is greater than or equal to the minimum required
-    if percent_overlap >= percent:
-        print("The two polygons coincide.")
-        return True
-    else:
-        print("The two polygons do not coincide.")
-        return False 
+    return percent_overlap >= percent
 
 
-""""
- * get the vertical interval from polygon
- * @param polygon object polygon
- * @returns vertical interval
-"""
-def pick_vertical_interval(polygon):
-    yArr = sorted([polygon[0].y, polygon[1].y, polygon[2].y, polygon[3].y])
-    return {
-        'yMax': yArr[3],
-        'yMin': yArr[0]
-    }
-
 """"
  * checks if two vertical intervals coincide in specific percent
  * @param a vertical interval
@@ -364,34 +388,22 @@ def pick_vertical_interval(polygon):
 def check_vertical_interval_intersection_in_percent(a, b, threshold_in_percent):
     common_ymax = float('NaN')
     common_ymin = float('NaN')
-    if b['yMin'] < a['yMax'] and a['yMax'] <= b['yMax']:
-        common_ymax = a['yMax']
-        common_ymin = a['yMin'] if a['yMin'] >= b['yMin'] else b['yMin']
-    elif a['yMin'] < b['yMax'] and b['yMax'] <= a['yMax']:
-        common_ymax = b['yMax']
-        common_ymin = b['yMin'] if b['yMin'] >= a['yMin'] else a['yMin']
+    if b.yMin < a.yMax and a.yMax <= b.yMax:
+        common_ymax = a.yMax
+        common_ymin = a.yMin if a.yMin >= b.yMin else b.yMin
+    elif a.yMin < b.yMax and b.yMax <= a.yMax:
+        common_ymax = b.yMax
+        common_ymin = b.yMin if b.yMin >= a.yMin else a.yMin
 
     if math.isnan(common_ymax) and math.isnan(common_ymin):
         return False
 
     common_len = common_ymax - common_ymin
     return (
-        common_len / (a['yMax'] - a['yMin']) > threshold_in_percent or
-        common_len / (b['yMax'] - b['yMin']) > threshold_in_percent
+        common_len / (a.yMax - a.yMin) > threshold_in_percent or
+        common_len / (b.yMax - b.yMin) > threshold_in_percent
     )
 
-""""
- * calculate geometric center coordinates from polygon
- * @param polygon object polygon
- * @returns geometric center coordinates
-"""
-def calc_geometric_center_coordinates(polygon):
-  x1 = polygon[0].x
-  y1 = polygon[0].y
-  x3 = polygon[2].x
-  y3 = polygon[2].y
-
-  return {'X': x3 - (x3 - x1) / 2, 'Y': y3 - (y3 - y1) / 2}
 #endregion
 
 """"
@@ -405,4 +417,14 @@ def parseOcrJsonToHtml(jsonString):
     if obj["status"] == "succeeded":
         element = renderPage(obj["analyzeResult"])
 
-    return element
\ No newline at end of file
+    return element
+
+""""
+ * parse a cached AnalyzeResult (utilities/formrecognizer.py cache, prebuilt-layout model) into html
+ * @param cachePath path of the serialized AnalyzeResult json
+ * @returns Html string.
+"""
+def parseCachedResultToHtml(cachePath):
+    with open(cachePath) as f:
+        result = AnalyzeResult.from_dict(json.load(f))
+    return renderPage(result)
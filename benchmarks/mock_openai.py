@@ -0,0 +1,117 @@
+import json, time, random, hashlib, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+EMBEDDING_DIMENSIONS = 64
+
+
+def fake_answer(prompt, unknown_rate):
+    # deterministic answer for the last line of the prompt (the field), Unknown for a share of the fields
+    field = prompt.rstrip().splitlines()[-1] if prompt.strip() else ''
+    digest = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16)
+    if (digest % 1000) / 1000 < unknown_rate:
+        return ' Unknown'
+    return f" {field.strip().rstrip(':')} value {digest % 10000}"
+
+def fake_embedding(text):
+    rng = random.Random(hashlib.md5(str(text).encode('utf-8')).hexdigest())
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+def approximate_tokens(text):
+    return max(1, len(str(text)) // 4)
+
+
+class MockOpenAIServer:
+    # Local OpenAI/Azure OpenAI compatible endpoint for the completions and embeddings calls,
+    # with a configurable latency and a share of requests answered with 429 + Retry-After.
+    def __init__(self, latency=0.2, jitter=0.1, rate_429=0.0, retry_after=1.0, unknown_rate=0.2, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.unknown_rate = unknown_rate
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'rate_limited': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body, headers={}):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                mock.count(requests=1)
+                if random.random() < mock.rate_429:
+                    mock.count(rate_limited=1)
+                    return self.send_json(429, {'error': {'message': 'Requests to the deployment have exceeded the rate limit (mock).', 'type': 'requests', 'code': '429'}},
+                                          {'Retry-After': str(int(mock.retry_after)), 'retry-after-ms': str(int(mock.retry_after * 1000))})
+                time.sleep(max(0.0, random.gauss(mock.latency, mock.jitter)))
+                if self.path.split('?')[0].endswith('/embeddings'):
+                    return self.send_json(200, self.embeddings(body))
+                if self.path.split('?')[0].endswith('/completions'):
+                    return self.send_json(200, self.completions(body))
+                self.send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+
+            def completions(self, body):
+                prompts = body.get('prompt', '')
+                prompts = prompts if isinstance(prompts, list) else [prompts]
+                choices = []
+                for i, prompt in enumerate(prompts):
+                    text = fake_answer(prompt, mock.unknown_rate)
+                    logprobs = {'tokens': text.split(), 'token_logprobs': [-0.1] * len(text.split())} if body.get('logprobs') else None
+                    choices.append({'text': text, 'index': i, 'logprobs': logprobs, 'finish_reason': 'stop'})
+                prompt_tokens = sum(approximate_tokens(p) for p in prompts)
+                completion_tokens = sum(approximate_tokens(c['text']) for c in choices)
+                mock.count(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                return {'id': 'cmpl-mock', 'object': 'text_completion', 'created': int(time.time()), 'model': body.get('model', 'mock'),
+                        'choices': choices, 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+
+            def embeddings(self, body):
+                inputs = body.get('input', [])
+                if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                    inputs = [inputs]
+                prompt_tokens = sum(len(i) if isinstance(i, list) else approximate_tokens(i) for i in inputs)
+                mock.count(prompt_tokens=prompt_tokens)
+                return {'object': 'list', 'model': body.get('model', 'mock'),
+                        'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text)} for i, text in enumerate(inputs)],
+                        'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens}}
+
+        return Handler
@@ -0,0 +1,179 @@
+import os, sys, json, time, argparse, resource, subprocess
+from datetime import datetime
+
+# The utilities read their configuration when imported: every prompt is sent (no completion cache)
+# and the quota scheduler shouldn't be the limit unless asked to be.
+os.environ.setdefault('COMPLETION_CACHE', 'none')
+os.environ.setdefault('OPENAI_TPM_LIMIT', '10000000')
+os.environ.setdefault('OPENAI_RPM_LIMIT', '1000000')
+os.environ.setdefault('OPENAI_MAX_BACKOFF', '2')
+os.environ.setdefault('TRANSLATE_ENDPOINT', 'https://translator.benchmark') # only the session is replaced by the stand-in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import openai
+import utilities.azureblobstorage as azureblobstorage
+import utilities.formrecognizer as formrecognizer
+import utilities.translator as translator
+import utilities.openaischeduler as openaischeduler
+import utilities.utils as utils
+from utilities.utils import complete_prompt, ask_all_fields, colorprint
+from utilities.pipeline import run_batch, FR_CONCURRENCY, OPENAI_CONCURRENCY
+from utilities.openaischeduler import get_scheduler
+from benchmarks.mock_openai import MockOpenAIServer
+from benchmarks.standins import load_fixtures, ReplayAnalysisClient, StandInContainerClient, StandInTranslatorSession, StandInEncoding, FIXTURES_DIR
+
+RESULTS_DIR = os.path.join('benchmarks', 'results')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Replay QnA_automated style batches against local stand-ins, no Azure calls.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='documents per batch')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='directory of recorded AnalyzeResult JSON files')
+    parser.add_argument('--questions', default='question.txt')
+    parser.add_argument('--fr-latency', type=float, default=1.0, help='seconds per Form Recognizer analysis')
+    parser.add_argument('--fr-jitter', type=float, default=0.3)
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='seconds per completion/embedding request')
+    parser.add_argument('--openai-jitter', type=float, default=0.05)
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of OpenAI requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After of the 429 answers, in seconds')
+    parser.add_argument('--translate', action='store_true', help='translate the chunks through the translator stand-in')
+    parser.add_argument('--translate-latency', type=float, default=0.1)
+    parser.add_argument('--single-call', action='store_true', help='ask all the fields in one completion')
+    parser.add_argument('--fr-concurrency', type=int, default=FR_CONCURRENCY)
+    parser.add_argument('--openai-concurrency', type=int, default=OPENAI_CONCURRENCY)
+    parser.add_argument('--output', help='JSON file of the results, default benchmarks/results/benchmark-<time>.json')
+    return parser.parse_args()
+
+def percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None}
+    return {'count': len(values), 'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95))}
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS), it is the peak of the whole process so far
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size, question, args, mock):
+    instruction, fields = question[0], question[1:]
+    timings = {'list': [], 'analyze': [], 'translate': [], 'answer': [], 'completion': []}
+
+    def timed(stage, function, *function_args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*function_args, **kwargs)
+        finally:
+            timings[stage].append(time.perf_counter() - start)
+
+    def analyze_file(file):
+        chunks = timed('analyze', formrecognizer.analyze_read, file['fullpath'])
+        if args.translate:
+            chunks = timed('translate', translator.translate_batch, chunks)
+        return chunks
+
+    def answer_file(file, chunks):
+        start = time.perf_counter()
+        context = ''.join(chunks)
+        answers = ask_all_fields(context, instruction, fields, temperature=0, restart_sequence='\n\n') if args.single_call else [None] * len(fields)
+        for i, (q, r) in enumerate(zip(fields, answers)):
+            if r is None:
+                answers[i] = timed('completion', complete_prompt, f"{context}\n\n{instruction}{q}", temperature=0, tokens_response=15)
+        timings['answer'].append(time.perf_counter() - start)
+        return answers
+
+    errors = []
+    azureblobstorage.get_container_client = lambda container_name=None: StandInContainerClient(size)
+    server_before = mock.stats()
+    scheduler_before = get_scheduler().utilization()
+    start = time.perf_counter()
+    files = timed('list', azureblobstorage.get_all_files)
+    results = run_batch(files, analyze_file, answer_file, fr_concurrency=args.fr_concurrency, openai_concurrency=args.openai_concurrency,
+                        on_error=lambda file, e: errors.append(repr(e)))
+    elapsed = time.perf_counter() - start
+    server_after = mock.stats()
+    scheduler_after = get_scheduler().utilization()
+
+    processed = len(results)
+    tokens = (server_after['prompt_tokens'] - server_before['prompt_tokens']) + (server_after['completion_tokens'] - server_before['completion_tokens'])
+    return {
+        'documents': size,
+        'processed': processed,
+        'failed_documents': size - processed,
+        'elapsed_seconds': elapsed,
+        'docs_per_second': processed / elapsed if elapsed > 0 else 0.0,
+        'tokens_per_document': tokens / processed if processed else 0.0,
+        'openai_requests': server_after['requests'] - server_before['requests'],
+        'openai_rate_limited': server_after['rate_limited'] - server_before['rate_limited'],
+        'openai_retries': scheduler_after['retries'] - scheduler_before['retries'],
+        'throttled_seconds': scheduler_after['throttled_seconds'] - scheduler_before['throttled_seconds'],
+        'waited_seconds': scheduler_after['waited_seconds'] - scheduler_before['waited_seconds'],
+        'latency_seconds': {stage: percentiles(values) for stage, values in timings.items() if values},
+        'peak_rss_mb': get_peak_rss_mb(),
+        # no document processed: the numbers above measure the failures, not the pipeline
+        'failed': processed == 0,
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def main():
+    args = get_args()
+    with open(args.questions) as f:
+        question = f.read().splitlines()
+
+    mock = MockOpenAIServer(latency=args.openai_latency, jitter=args.openai_jitter, rate_429=args.rate_429, retry_after=args.retry_after).start()
+    openai.api_type = 'azure'
+    openai.api_base = mock.url
+    openai.api_version = '2022-12-01'
+    openai.api_key = 'benchmark'
+    fixtures = load_fixtures(args.fixtures)
+    formrecognizer.get_document_analysis_client = lambda: ReplayAnalysisClient(fixtures, args.fr_latency, args.fr_jitter)
+    azureblobstorage.get_container_sas = lambda container_name=None, hours=3: 'sv=benchmark'
+    translator_session = StandInTranslatorSession(args.translate_latency)
+    translator.get_session = lambda: translator_session
+    translator.LANGUAGE_PREDETECT = False
+    encoding = StandInEncoding()
+    openaischeduler.get_encoding = lambda model: encoding
+    utils.get_embedding_encoding = lambda engine='text-embedding-ada-002': encoding
+
+    report = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': get_git_commit(),
+        'config': vars(args),
+        'fixtures': len(fixtures),
+        'runs': [],
+    }
+    try:
+        for size in args.sizes:
+            colorprint(f"BENCHMARK: {size} documents", '44')
+            result = run(size, question, args, mock)
+            report['runs'].append(result)
+            if result['failed']:
+                colorprint(f"{size} documents: every document failed, first error: {result['first_error']}", '196')
+                continue
+            # no answer latency when every document failed
+            answer = result['latency_seconds'].get('answer')
+            answer_p95 = f"{answer['p95']:.2f}s" if answer else 'n/a'
+            colorprint(f"{size} documents: {result['docs_per_second']:.2f} docs/s, {result['tokens_per_document']:.0f} tokens/doc, "
+                       f"answer p95 {answer_p95}, peak RSS {result['peak_rss_mb']:.0f} MB", '44')
+    finally:
+        mock.stop()
+        # the runs done so far are kept even when one of them raised
+        output = args.output or os.path.join(RESULTS_DIR, f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        colorprint(f"Results written to {output}", '44')
+    if any(result['failed'] for result in report['runs']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
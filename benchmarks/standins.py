@@ -0,0 +1,175 @@
+import os, json, glob, time, random, asyncio, hashlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from azure.core.exceptions import ResourceNotFoundError
+from azure.ai.formrecognizer import AnalyzeResult
+
+# recorded results, e.g. the Form Recognizer cache of a real run
+FIXTURES_DIR = os.path.join('data', 'fr_cache', 'prebuilt-layout')
+
+
+def load_fixtures(path=FIXTURES_DIR):
+    # AnalyzeResult dicts (as written by formrecognizer.save_cached_result), synthetic ones when there are none
+    fixtures = []
+    for file_name in sorted(glob.glob(os.path.join(path, '*.json'))):
+        with open(file_name) as f:
+            fixtures.append(json.load(f))
+    return fixtures or [synthetic_result(pages) for pages in (1, 2, 3, 6, 12)]
+
+def synthetic_result(pages=2):
+    # A small prebuilt-layout result: per page a couple of key/value paragraphs and a 3x2 table
+    def polygon(x0, y0, x1, y1):
+        return [{'x': x0, 'y': y0}, {'x': x1, 'y': y0}, {'x': x1, 'y': y1}, {'x': x0, 'y': y1}]
+    content = ''
+    result_pages, paragraphs, tables = [], [], []
+    for page_number in range(1, pages + 1):
+        page_start = len(content)
+        words = []
+        def add(text, x, y):
+            nonlocal content
+            for word in text.split():
+                words.append({'content': word, 'polygon': polygon(x, y, x + 0.1 * len(word), y + 0.2), 'span': {'offset': len(content), 'length': len(word)}, 'confidence': 0.99})
+                content += word + ' '
+                x += 0.1 * len(word) + 0.1
+        for line, text in enumerate([f"Patient Name: Jane Doe {page_number}", "Patient Address: 1 High Street, Springfield", "DOB: 01/02/1980",
+                                     "Medication: amoxicillin 500 mg three times a day", "Prescriber: Dr A. Smith"]):
+            start = len(content)
+            add(text, 1, 1 + line * 0.5)
+            paragraphs.append({'role': None, 'content': text, 'bounding_regions': [{'page_number': page_number, 'polygon': polygon(1, 1 + line * 0.5, 6, 1.2 + line * 0.5)}],
+                               'spans': [{'offset': start, 'length': len(content) - 1 - start}]})
+        cells = []
+        table_start = len(content)
+        for row in range(3):
+            for column in range(2):
+                text = ['Drug', 'Dose'][column] if row == 0 else f"item{row}{column}"
+                start = len(content)
+                add(text, 1 + column * 2, 4 + row * 0.5)
+                cells.append({'kind': 'content', 'row_index': row, 'column_index': column, 'row_span': 1, 'column_span': 1, 'content': text,
+                              'bounding_regions': [{'page_number': page_number, 'polygon': polygon(1 + column * 2, 4 + row * 0.5, 2.9 + column * 2, 4.4 + row * 0.5)}],
+                              'spans': [{'offset': start, 'length': len(text)}]})
+        tables.append({'row_count': 3, 'column_count': 2, 'cells': cells, 'bounding_regions': [{'page_number': page_number, 'polygon': polygon(1, 4, 5, 5.5)}],
+                       'spans': [{'offset': table_start, 'length': len(content) - table_start}]})
+        result_pages.append({'page_number': page_number, 'angle': 0, 'width': 8.5, 'height': 11, 'unit': 'inch', 'words': words, 'selection_marks': [], 'lines': [],
+                             'spans': [{'offset': page_start, 'length': len(content) - page_start}]})
+    return {'api_version': '2022-08-31', 'model_id': 'prebuilt-layout', 'content': content, 'pages': result_pages, 'paragraphs': paragraphs,
+            'tables': tables, 'key_value_pairs': [], 'styles': [], 'documents': [], 'languages': []}
+
+
+class ReplayAnalysisClient:
+    # Stand-in for DocumentAnalysisClient: every url gets one of the fixtures (always the same one) after `latency` seconds
+    def __init__(self, fixtures, latency=1.0, jitter=0.3):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+
+    def fixture_for(self, url):
+        return self.fixtures[int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16) % len(self.fixtures)]
+
+    def begin_analyze_document_from_url(self, model_id, document_url, **kwargs):
+        fixture = self.fixture_for(document_url)
+        latency = max(0.0, random.gauss(self.latency, self.jitter))
+        def result():
+            time.sleep(latency)
+            return AnalyzeResult.from_dict(fixture)
+        return SimpleNamespace(result=result)
+
+
+class AsyncReplayAnalysisClient(ReplayAnalysisClient):
+    # Stand-in for azure.ai.formrecognizer.aio.DocumentAnalysisClient, e.g. for asyncformrecognizer.AsyncDocumentAnalyzer.
+    # `latencies` overrides the latency of some urls; the analyses running, their peak and the cancelled ones are counted.
+    def __init__(self, fixtures, latency=1.0, jitter=0.3, latencies=None):
+        super().__init__(fixtures, latency, jitter)
+        self.latencies = latencies or {}
+        self.running = 0
+        self.max_running = 0
+        self.cancelled = 0
+
+    async def begin_analyze_document_from_url(self, model_id, document_url, **kwargs):
+        fixture = self.fixture_for(document_url)
+        latency = self.latencies.get(document_url, max(0.0, random.gauss(self.latency, self.jitter)))
+        async def result():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(latency)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            finally:
+                self.running -= 1
+            return AnalyzeResult.from_dict(fixture)
+        return SimpleNamespace(result=result)
+
+    async def close(self):
+        pass
+
+
+class StandInContainerClient:
+    # Stand-in for the ContainerClient used by azureblobstorage.get_all_files / iter_changed_files, with `count` pdf blobs
+    def __init__(self, count, url='https://benchmark.blob.core.windows.net/documents'):
+        self.url = url
+        self.container_name = url.rsplit('/', 1)[-1]
+        self.blobs = [stand_in_blob(f"doc{i:05d}.pdf", f"content {i}".encode('utf-8'), f'"0x{i:016X}"') for i in range(count)]
+
+    def list_blobs(self, name_starts_with=None, include=None, results_per_page=5000):
+        blobs = [b for b in self.blobs if not name_starts_with or b.name.startswith(name_starts_with)]
+        return StandInBlobList(blobs, results_per_page)
+
+    def get_blob_client(self, name):
+        def get_blob_properties():
+            for blob in self.blobs:
+                if blob.name == name:
+                    return blob
+            raise ResourceNotFoundError(f"The specified blob {name} does not exist.")
+        return SimpleNamespace(get_blob_properties=get_blob_properties)
+
+def stand_in_blob(name, content, etag):
+    return SimpleNamespace(name=name, etag=etag, metadata={}, last_modified=datetime.now(timezone.utc),
+                           content_settings=SimpleNamespace(content_md5=bytearray(hashlib.md5(content).digest())))
+
+class StandInBlobList:
+    def __init__(self, blobs, results_per_page):
+        self.blobs = blobs
+        self.results_per_page = results_per_page
+
+    def __iter__(self):
+        return iter(self.blobs)
+
+    def by_page(self, continuation_token=None):
+        return StandInPages(self.blobs, self.results_per_page, int(continuation_token or 0))
+
+class StandInPages:
+    def __init__(self, blobs, results_per_page, start):
+        self.blobs = blobs
+        self.results_per_page = results_per_page
+        self.start = start
+        self.continuation_token = None
+
+    def __iter__(self):
+        for start in range(self.start, len(self.blobs), self.results_per_page):
+            end = start + self.results_per_page
+            self.continuation_token = str(end) if end < len(self.blobs) else None
+            yield iter(self.blobs[start:end])
+
+
+class StandInEncoding:
+    # Stand-in for a tiktoken encoding, 4 characters per token like the mock OpenAI endpoint, without downloading the BPE files
+    def encode(self, text):
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+class StandInTranslatorSession:
+    # Stand-in for translator.get_session(): every text is detected as `detected_language` and returned as is
+    def __init__(self, latency=0.1, detected_language='es'):
+        self.latency = latency
+        self.detected_language = detected_language
+        self.requests = 0
+
+    def post(self, url, params=None, json=None):
+        self.requests += 1
+        time.sleep(self.latency)
+        response = [{'detectedLanguage': {'language': self.detected_language, 'score': 1.0}, 'translations': [{'text': e['text'], 'to': 'en'}]} for e in json]
+        return SimpleNamespace(raise_for_status=lambda: None, json=lambda: response)
@@ -0,0 +1,6 @@
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the utilities package, and the HTML renderer which imports its sibling modules directly
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'SourceCode&ReadMe'))
@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+from utilities import formrecognizer
+from utilities.asyncformrecognizer import AsyncDocumentAnalyzer, analyze_documents
+from benchmarks.standins import AsyncReplayAnalysisClient, synthetic_result
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(formrecognizer, 'FR_CACHE_DIR', str(tmp_path))
+
+def make_files(count):
+    return [{'filename': f"doc{i}.pdf", 'fullpath': f"https://blob/doc{i}.pdf?sas", 'cache_key': None} for i in range(count)]
+
+
+def test_results_come_in_completion_order_within_the_bound():
+    files = make_files(6)
+    # doc0 and doc1 hold two slots while doc2..doc5 pass through the third one
+    latencies = {file['fullpath']: seconds for file, seconds in zip(files, [0.3, 0.2, 0.05, 0.05, 0.05, 0.02])}
+    client = AsyncReplayAnalysisClient([synthetic_result(1)], latencies=latencies)
+    async def run():
+        async with AsyncDocumentAnalyzer(client, in_flight=3, polling_interval=0) as analyzer:
+            return [file['filename'] async for file, _ in analyzer.analyze_many('prebuilt-layout', files)]
+    order = asyncio.run(run())
+    assert order == ['doc2.pdf', 'doc3.pdf', 'doc4.pdf', 'doc5.pdf', 'doc1.pdf', 'doc0.pdf']
+    assert client.max_running == 3
+
+def test_all_files_are_analyzed():
+    client = AsyncReplayAnalysisClient([synthetic_result(1), synthetic_result(2)], latency=0.01, jitter=0.005)
+    results = analyze_documents('prebuilt-layout', make_files(20), client=client, in_flight=4, polling_interval=0)
+    assert sorted(results) == sorted(f"doc{i}.pdf" for i in range(20))
+    assert client.max_running <= 4
+
+def test_closing_early_cancels_the_pending_analyses():
+    client = AsyncReplayAnalysisClient([synthetic_result(1)], latency=0.01, jitter=0)
+    files = make_files(5)
+    client.latencies = {file['fullpath']: 10 for file in files[1:]}
+    async def run():
+        async with AsyncDocumentAnalyzer(client, in_flight=5, polling_interval=0) as analyzer:
+            results = analyzer.analyze_many('prebuilt-layout', files)
+            async for file, _ in results:
+                break
+            await results.aclose()
+            # checked before asyncio.run would cancel any leftover task itself
+            return file, client.cancelled, client.running
+    file, cancelled, running = asyncio.run(asyncio.wait_for(run(), 5))
+    assert file['filename'] == 'doc0.pdf'
+    assert cancelled == 4 and running == 0
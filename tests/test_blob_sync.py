@@ -0,0 +1,124 @@
+from types import SimpleNamespace
+import pytest
+from utilities import azureblobstorage
+from utilities.azureblobstorage import BlobManifest, iter_changed_files
+from benchmarks.standins import StandInContainerClient, stand_in_blob
+
+
+@pytest.fixture
+def container(monkeypatch):
+    container = StandInContainerClient(5)
+    monkeypatch.setattr(azureblobstorage, 'get_container_client', lambda container_name=None: container)
+    monkeypatch.setattr(azureblobstorage, 'get_container_sas', lambda container_name=None, hours=3: 'sas')
+    monkeypatch.setattr(azureblobstorage, 'get_change_feed_client', lambda: None)
+    monkeypatch.setattr(azureblobstorage, 'BLOB_LIST_PAGE_SIZE', 2)
+    return container
+
+def sync(manifest, state='done'):
+    files = list(iter_changed_files(manifest=manifest))
+    for file in files:
+        manifest.set_state(file['filename'], state)
+    return {file['filename']: file['cache_key'] for file in files}
+
+
+def test_only_changed_blobs_come_back(container, tmp_path):
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    assert len(sync(manifest)) == 5
+    assert sync(manifest) == {}
+    # metadata written after the conversion changes the ETag, not the content
+    container.blobs[0].etag = '"0xMETADATA"'
+    container.blobs[0].metadata = {'converted': 'true'}
+    assert sync(manifest) == {}
+    container.blobs[1] = stand_in_blob(container.blobs[1].name, b'new content', '"0xNEW"')
+    assert list(sync(manifest)) == [container.blobs[1].name]
+
+def test_unfinished_blobs_come_back_with_their_current_content(container, tmp_path):
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    first = sync(manifest, state='failed')
+    container.blobs[2] = stand_in_blob(container.blobs[2].name, b'uploaded again', '"0xAGAIN"')
+    second = sync(manifest)
+    assert second.keys() == first.keys()
+    assert second[container.blobs[2].name] != first[container.blobs[2].name]
+    assert second[container.blobs[2].name] == manifest.get(container.blobs[2].name)['cache_key']
+
+def test_deleted_blobs_are_forgotten(container, tmp_path):
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    sync(manifest, state='failed')
+    deleted = container.blobs.pop(3)
+    assert deleted.name not in sync(manifest)
+    assert manifest.get(deleted.name) is None
+    done = container.blobs.pop(0)
+    sync(manifest)
+    assert manifest.get(done.name) is None
+    assert all(manifest.get(blob.name) for blob in container.blobs)
+
+def test_blobs_without_md5_use_the_etag_by_default(container, tmp_path, monkeypatch):
+    monkeypatch.setattr(azureblobstorage, 'hash_blob', lambda blob, container_name=None: pytest.fail('listing must not download blobs'))
+    container.blobs[4].content_settings = SimpleNamespace(content_md5=None)
+    files = sync(BlobManifest(str(tmp_path / 'manifest.sqlite')))
+    assert files[container.blobs[4].name] == container.blobs[4].etag.strip('"')
+
+def test_blobs_without_md5_are_hashed_once(container, tmp_path, monkeypatch):
+    hashed = []
+    def hash_blob(blob, container_name=None):
+        hashed.append(blob.name)
+        blob.content_settings.content_md5 = bytearray(b'\x01' * 16)
+        return '01' * 16
+    monkeypatch.setattr(azureblobstorage, 'hash_blob', hash_blob)
+    monkeypatch.setattr(azureblobstorage, 'BLOB_HASH_MISSING_MD5', True)
+    container.blobs[4].content_settings = SimpleNamespace(content_md5=None)
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    files = sync(manifest)
+    assert hashed == [container.blobs[4].name]
+    assert files[container.blobs[4].name] == '01' * 16
+    assert sync(manifest) == {}
+    assert hashed == [container.blobs[4].name]
+
+def test_prefixes_are_not_patterns(tmp_path):
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    for name in ['a_1.pdf', 'ab1.pdf', 'a%2.pdf']:
+        manifest.upsert(name, 'etag', None, 'key', state='failed', listed_pass='old')
+    assert manifest.unfinished('a_') == ['a_1.pdf']
+    assert manifest.delete_unlisted('a%', 'new') == 1
+    assert manifest.unfinished() == ['a_1.pdf', 'ab1.pdf']
+
+class StandInChangeFeedClient:
+    def __init__(self, container_name):
+        self.subject = f"/blobServices/default/containers/{container_name}/blobs/"
+        self.events = []
+        self.calls = []
+
+    def event(self, event_type, name):
+        self.events.append({'eventType': event_type, 'subject': self.subject + name})
+
+    def list_changes(self, start_time=None, results_per_page=None):
+        client = self
+        class Pages:
+            def by_page(self, continuation_token=None):
+                client.calls.append(start_time or continuation_token)
+                self.page = client.events[int(continuation_token or 0):]
+                self.continuation_token = str(len(client.events))
+                return self
+            def __iter__(self):
+                return iter([self.page])
+        return Pages()
+
+def test_change_feed_replaces_the_listing(container, tmp_path, monkeypatch):
+    change_feed = StandInChangeFeedClient(container.container_name)
+    monkeypatch.setattr(azureblobstorage, 'get_change_feed_client', lambda: change_feed)
+    listed = []
+    list_blobs = container.list_blobs
+    monkeypatch.setattr(container, 'list_blobs', lambda **kwargs: listed.append(1) or list_blobs(**kwargs))
+    manifest = BlobManifest(str(tmp_path / 'manifest.sqlite'))
+    assert len(sync(manifest)) == 5
+    assert listed == [1]
+    container.blobs.append(stand_in_blob('new.pdf', b'new', '"0xNEW"'))
+    deleted = container.blobs.pop(0)
+    change_feed.event('BlobCreated', 'new.pdf')
+    change_feed.event('BlobDeleted', deleted.name)
+    change_feed.event('BlobCreated', 'converted/new.pdf.zip')
+    assert list(sync(manifest)) == ['new.pdf']
+    assert manifest.get(deleted.name) is None
+    assert sync(manifest) == {}
+    assert listed == [1]
+    assert change_feed.calls[1:] == ['3']
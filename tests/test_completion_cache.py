@@ -0,0 +1,34 @@
+import sqlite3
+from utilities.completioncache import SQLiteCompletionStore
+
+
+def keys(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT key FROM completions")}
+
+def test_least_recently_used_entries_are_evicted_in_batches(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    store = SQLiteCompletionStore(path, max_entries=10, evict_batch=4, touch_batch=1000)
+    for i in range(10):
+        store.set(f"k{i}", {'i': i})
+    assert store.get('k0') == {'i': 0}
+    store.set('k10', {'i': 10})
+    # down to 4 below the limit, k0 was used after k1..k5 which go first
+    assert keys(path) == {'k0', 'k6', 'k7', 'k8', 'k9', 'k10'}
+    assert store.size == 6
+    store.set('k10', {'i': 11})
+    assert store.size == 6 and store.get('k10') == {'i': 11}
+
+def test_hits_are_written_in_batches(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    store = SQLiteCompletionStore(path, touch_batch=3)
+    store.set('k', {'text': 'cached'})
+    for _ in range(2):
+        store.get('k')
+    assert store.touched
+    store.get('k')
+    assert not store.touched
+    store.get('k')
+    store.flush()
+    assert not store.touched
+    assert SQLiteCompletionStore(path).size == 1
@@ -0,0 +1,20 @@
+from utilities.utils import parse_field_answers
+
+FIELDS = [' Patient Name:', ' DOB:', ' Service (Gastroenterology, Rheumatology, Cardiology, Neurology, Endocrinology, Oncology, Not present):', ' Route:']
+
+
+def test_numbered_answers():
+    assert parse_field_answers("1: John Smith\n2: 12/03/1961\n3. Cardiology\n4) oral", FIELDS) == ['John Smith', '12/03/1961', 'Cardiology', 'oral']
+
+def test_echoed_labels_are_removed():
+    text = "1. Patient Name: John Smith\n2: dob: 12/03/1961\n3. Service: Cardiology\n4. Route: oral"
+    assert parse_field_answers(text, FIELDS) == ['John Smith', '12/03/1961', 'Cardiology', 'oral']
+
+def test_answers_with_a_colon_are_kept():
+    assert parse_field_answers("2: 12/03/1961 10:30", FIELDS)[1] == '12/03/1961 10:30'
+
+def test_missing_numbers_are_matched_by_label():
+    assert parse_field_answers("Patient Name: John Smith\nSomething else: x\n4: subcutaneous", FIELDS) == ['John Smith', None, None, 'subcutaneous']
+
+def test_out_of_range_numbers_and_repeats_are_ignored():
+    assert parse_field_answers("0: nobody\n5: too far\n1: John Smith\n1: Jane Doe\n2:", FIELDS) == ['John Smith', None, None, None]
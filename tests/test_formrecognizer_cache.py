@@ -0,0 +1,14 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from azure.ai.formrecognizer import AnalyzeResult
+from utilities import formrecognizer
+from benchmarks.standins import synthetic_result
+
+
+def test_concurrent_saves_of_the_same_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(formrecognizer, 'FR_CACHE_DIR', str(tmp_path))
+    result = AnalyzeResult.from_dict(synthetic_result(1))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: formrecognizer.save_cached_result('prebuilt-layout', 'same-key', result), range(64)))
+    assert formrecognizer.load_cached_result('prebuilt-layout', 'same-key').content == result.content
+    assert not [name for name in os.listdir(tmp_path / 'prebuilt-layout') if name.endswith('.tmp')]
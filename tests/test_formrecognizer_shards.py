@@ -0,0 +1,55 @@
+import threading
+import pytest
+from types import SimpleNamespace
+from azure.core.exceptions import HttpResponseError
+from azure.ai.formrecognizer import AnalyzeResult
+from utilities import formrecognizer
+from benchmarks.standins import synthetic_result
+
+
+class PagedAnalysisClient:
+    # Stand-in for DocumentAnalysisClient with a document of `page_count` pages: a range past the last
+    # page is rejected with a 400 like the service does
+    def __init__(self, page_count):
+        self.page_count = page_count
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def begin_analyze_document_from_url(self, model_id, document_url, pages=None):
+        first, last = map(int, pages.split('-'))
+        with self.lock:
+            self.ranges.append((first, last))
+        if first > self.page_count:
+            error = HttpResponseError(message='InvalidParameter: the pages parameter is out of range')
+            error.status_code = 400
+            raise error
+        result = AnalyzeResult.from_dict(synthetic_result(min(last, self.page_count) - first + 1))
+        return SimpleNamespace(result=lambda: result)
+
+def analyze(monkeypatch, page_count, shard_pages=10, concurrency=4):
+    client = PagedAnalysisClient(page_count)
+    monkeypatch.setattr(formrecognizer, 'get_document_analysis_client', lambda: client)
+    result = formrecognizer.analyze_document_shards('prebuilt-layout', 'https://blob/doc.pdf', shard_pages, concurrency)
+    return result, sorted(client.ranges)
+
+
+@pytest.mark.parametrize('page_count', [1, 9])
+def test_short_documents_take_one_request(monkeypatch, page_count):
+    result, ranges = analyze(monkeypatch, page_count)
+    assert ranges == [(1, 10)]
+    assert len(result.pages) == page_count
+
+def test_long_documents_fan_out_after_the_first_range(monkeypatch):
+    result, ranges = analyze(monkeypatch, 25)
+    assert ranges == [(1, 10), (11, 20), (21, 30), (31, 40), (41, 50)]
+    assert len(result.pages) == 25
+
+def test_ranges_past_the_last_page_are_ignored(monkeypatch):
+    # the first range is full and the document ends exactly there: the next wave is only 400s
+    result, ranges = analyze(monkeypatch, 10)
+    assert ranges == [(1, 10), (11, 20), (21, 30), (31, 40), (41, 50)]
+    assert len(result.pages) == 10
+
+def test_an_invalid_first_range_raises(monkeypatch):
+    with pytest.raises(HttpResponseError):
+        analyze(monkeypatch, 0)
@@ -0,0 +1,62 @@
+import os, json, time, threading, tracemalloc, cProfile
+from concurrent.futures import ThreadPoolExecutor
+from utilities import instrumentation
+from utilities.instrumentation import profile_document
+
+
+def test_documents_are_profiled_one_at_a_time_without_waiting(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(instrumentation, 'metrics', instrumentation.Metrics(str(tmp_path / 'metrics.jsonl')))
+    lock = threading.Lock()
+    active = []
+    profiling = []
+    overlaps = []
+    class Profile(cProfile.Profile):
+        def enable(self):
+            with lock:
+                profiling.append(self)
+                overlaps.append(len(profiling) > 1)
+            super().enable()
+        def disable(self):
+            super().disable()
+            # dump_stats disables the profiler a second time
+            with lock:
+                if self in profiling:
+                    profiling.remove(self)
+    monkeypatch.setattr(instrumentation.cProfile, 'Profile', Profile)
+    most_active = []
+    barrier = threading.Barrier(4)
+    def process(name):
+        barrier.wait()
+        with profile_document(name, enabled=True):
+            with lock:
+                active.append(name)
+                most_active.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(name)
+    # same base names in different folders, and a document processed twice
+    names = ['a/form.pdf', 'b/form.pdf', 'c/form.pdf', 'a/form.pdf']
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(process, names))
+            # the next batch of documents is profiled again, each under its own file name
+            list(executor.map(process, names))
+    finally:
+        tracemalloc.stop()
+    assert not any(overlaps)
+    assert max(most_active) > 1
+    profiles = os.listdir(tmp_path / 'profiles')
+    assert 2 <= len(profiles) < 2 * len(names) and len(set(profiles)) == len(profiles)
+    instrumentation.metrics.log.close()
+    with open(tmp_path / 'metrics.jsonl') as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == len(profiles)
+    assert all('rss_delta_bytes' in e and 'bytes' not in e for e in entries)
+    assert instrumentation.metrics.stats()['document']['bytes'] == 0
+
+def test_metrics_log_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = instrumentation.Metrics()
+    metrics.record('completion', 0.1, prompt_tokens=10)
+    assert metrics.log is None and os.listdir(tmp_path) == []
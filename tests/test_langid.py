@@ -0,0 +1,89 @@
+import pytest
+from utilities.langid import detect_language
+from utilities.translator import is_in_language
+
+ENGLISH_FORMS = [
+    """PRESCRIPTION
+Patient name: Margaret O'Neill   DOB: 11/03/1954   MRN: 00482913
+Address: 14 Elm Grove, Leeds LS6 2AB
+Rx: Metformin 500 mg tablets. Sig: take 1 tablet by mouth twice daily with meals. Qty: 60. Refills: 3
+Prescriber: Dr. A. Patel, MBBS   GMC No. 7034521
+Signature: ____________   Date: 02/05/2023""",
+    """Name of insured person: Carlos Mendez
+Policy number: HX-2231-77
+Date of accident: 14 July 2022
+Describe how the accident happened: I was driving north on Main Street when the other vehicle failed to stop at the red light and hit the passenger side of my car.
+Were the police called? Yes. Report number 22-118734""",
+    """EMPLOYMENT APPLICATION FORM
+Position applied for: Warehouse supervisor
+Are you legally entitled to work in the United Kingdom? Yes
+Previous employer: Tesco Distribution Centre, Daventry
+Reason for leaving: relocation
+I confirm that the information given in this form is true and complete.""",
+    """Member ID: 889 221 004  Group No: 55120
+Provider: St. Mary's Hospital  NPI 1457389021
+Date of service  CPT  Description  Charge
+03/14/2023  99213  Office visit, established patient  $145.00
+03/14/2023  85025  Complete blood count  $38.00
+Amount you may owe: $36.60""",
+]
+
+ENGLISH_INVOICE = """Invoice No: INV-004512  Date: 2023-01-17  Due date: 2023-02-16
+Bill to: Northwind Traders Ltd, 55 King Street, Manchester M2 4LQ
+Description  Qty  Unit price  Amount
+Consulting services January  12  150.00  1,800.00
+Travel expenses  1  230.50  230.50
+Subtotal 2,030.50  VAT 20% 406.10  Total due 2,436.60
+Payment terms: 30 days. Please quote the invoice number with your payment."""
+
+FOREIGN_FORMS = {
+    'de': """Rezept. Patient: Hans Müller, geb. 12.04.1961, Versichertennummer A123456789
+Medikament: Ibuprofen 400 mg Filmtabletten, dreimal täglich eine Tablette nach dem Essen einnehmen.
+Arzt: Dr. med. Sabine Weber, Fachärztin für Allgemeinmedizin, Hauptstraße 5, 80331 München""",
+    'es': """Receta médica. Nombre del paciente: María García López. Fecha de nacimiento: 23/08/1975.
+Medicamento: Amoxicilina 500 mg cápsulas. Tomar una cápsula cada ocho horas durante siete días.
+Médico: Dr. Javier Ruiz, colegiado número 28/12345. Firma del médico.""",
+    'fr': """Ordonnance. Nom du patient : Jean Dupont, né le 03/02/1958.
+Paracétamol 1 g : un comprimé trois fois par jour pendant cinq jours, en cas de douleur ou de fièvre.
+Docteur Claire Martin, médecin généraliste, 12 rue de la République, 69002 Lyon. Signature.""",
+}
+
+# languages without a sample in utilities/langsamples
+UNKNOWN_LANGUAGE_FORMS = [
+    """Recepta. Imię i nazwisko pacjenta: Anna Kowalska, data urodzenia 15.06.1980, PESEL 80061512345.
+Lek: Amoksycylina 500 mg, kapsułki. Stosować jedną kapsułkę trzy razy dziennie przez siedem dni.
+Lekarz: dr Piotr Nowak, specjalista chorób wewnętrznych. Podpis i pieczątka lekarza.""",
+    """Recept. Patientens namn: Erik Johansson, personnummer 19720314-1234.
+Läkemedel: Alvedon 500 mg tabletter. Ta två tabletter högst fyra gånger per dygn vid behov.
+Förskrivare: leg. läkare Maria Lindqvist, Vårdcentralen Söder, Stockholm. Underskrift.""",
+]
+
+MIXED_FORMS = [
+    """Patient name: John Smith. Diagnose: Der Patient klagt über starke Kopfschmerzen seit drei Tagen und hat Fieber. Medication: ibuprofen 400 mg twice daily, to be taken after meals.""",
+    """Name / Name: Peter Schmidt. Geburtsdatum / Date of birth: 01.02.1970. Bitte füllen Sie das Formular vollständig aus. Please complete the form in full and sign below. Unterschrift / Signature""",
+]
+
+
+@pytest.mark.parametrize('text', ENGLISH_FORMS)
+def test_english_forms_are_kept(text):
+    assert is_in_language(text, 'en')
+
+def test_confidence_depends_on_the_margin_not_the_length():
+    language, confidence = detect_language(ENGLISH_INVOICE)
+    assert language == 'en'
+    # codes and amounts leave little English to go on: not confident enough to skip the translator
+    assert 0.5 < confidence < 0.99
+    assert detect_language(ENGLISH_INVOICE + '\n' + ENGLISH_INVOICE)[1] == pytest.approx(confidence)
+
+@pytest.mark.parametrize('language', FOREIGN_FORMS)
+def test_foreign_forms_are_translated(language):
+    assert detect_language(FOREIGN_FORMS[language])[0] == language
+    assert not is_in_language(FOREIGN_FORMS[language], 'en')
+
+@pytest.mark.parametrize('text', UNKNOWN_LANGUAGE_FORMS + MIXED_FORMS)
+def test_unknown_and_mixed_forms_are_translated(text):
+    assert detect_language(text)[0] != 'en'
+    assert not is_in_language(text, 'en')
+
+def test_short_texts_are_uncertain():
+    assert detect_language('Date: 02/05/2023  Qty: 60') == (None, 0.0)
@@ -0,0 +1,32 @@
+import time, threading
+import openai
+from utilities.openaischeduler import OpenAIScheduler
+
+
+def rate_limit_error(retry_after):
+    return openai.error.RateLimitError('rate limited', headers={'Retry-After': str(retry_after)})
+
+def test_a_429_pause_is_counted_once():
+    scheduler = OpenAIScheduler(tpm=1000, rpm=10)
+    scheduler.backoff(rate_limit_error(0.2), 0)
+    # a second 429 during the pause only extends it by the part not already covered
+    scheduler.backoff(rate_limit_error(0.1), 0)
+    threads = [threading.Thread(target=scheduler.acquire, args=(10,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = scheduler.utilization()
+    assert 0.19 <= scheduler.throttled_seconds <= 0.21
+    assert stats['rate_limited'] == 2
+    # every caller waited for the same pause
+    assert scheduler.waited_seconds >= 4 * 0.15
+
+def test_retry_after_jitter_scales_with_the_delay():
+    scheduler = OpenAIScheduler()
+    delays = [scheduler.backoff(rate_limit_error(0.05), 0) for _ in range(50)]
+    assert all(0.05 <= delay <= 0.055 for delay in delays)
+    delays = [scheduler.backoff(rate_limit_error(30), 0) for _ in range(50)]
+    assert all(30 <= delay <= 31 for delay in delays)
+    # the shared pause is the Retry-After itself
+    assert scheduler.paused_until - time.monotonic() <= 30
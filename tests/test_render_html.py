@@ -0,0 +1,96 @@
+import re, random
+from types import SimpleNamespace
+import pytest
+from azure.ai.formrecognizer import AnalyzeResult
+import parseFormRecognizerJsontoHtml as renderer
+from layoutmodel import VerticalInterval, ElementType, PageLayout
+from benchmarks.standins import synthetic_result
+
+
+def baseline_cluster_lines(elements, threshold_in_percent):
+    # the original grouping of output_html_by_base_elements: every element against the last element of every line
+    lines = []
+    for ele in elements:
+        for line in lines:
+            if renderer.check_vertical_interval_intersection_in_percent(line[1][-1].verticalInterval, ele.verticalInterval, threshold_in_percent):
+                line[1].append(ele)
+                break
+        else:
+            lines.append(((ele.verticalInterval.yMax + ele.verticalInterval.yMin) / 2, [ele]))
+    return sorted(lines, key=lambda line: line[0])
+
+def random_elements(rng, count, jitter, tall_rate=0.0):
+    elements = []
+    for i in range(count):
+        line = rng.randrange(count // 8 + 1)
+        height = rng.uniform(0.1, 0.3) if rng.random() >= tall_rate else rng.uniform(1, 5)
+        center = line * 0.25 + rng.gauss(0, jitter)
+        elements.append(SimpleNamespace(id=i, verticalInterval=VerticalInterval(center + height / 2, center - height / 2)))
+    return elements
+
+def partition(lines):
+    return [(key, [ele.id for ele in elements]) for key, elements in lines]
+
+
+@pytest.mark.parametrize('jitter', [0.0, 0.005, 0.04])
+@pytest.mark.parametrize('tall_rate', [0.0, 0.02])
+def test_cluster_lines_matches_baseline_grouping(jitter, tall_rate):
+    rng = random.Random(f"{jitter}-{tall_rate}")
+    for _ in range(300):
+        elements = random_elements(rng, rng.randrange(1, 120), jitter, tall_rate)
+        assert partition(renderer.cluster_lines(elements, 0.7)) == partition(baseline_cluster_lines(elements, 0.7))
+
+def test_cluster_lines_empty():
+    assert renderer.cluster_lines([], 0.7) == []
+
+
+def words(line):
+    # words of a rendered line, without the <p> and list wrapping
+    return re.sub(r"</?p>|[\[\]']", ' ', str(line)).split()
+
+def test_multi_page_paragraphs_are_rendered_per_page():
+    pages = 5
+    groups = renderer.renderPage(AnalyzeResult.from_dict(synthetic_result(pages)))
+    # the synthetic pages have the same layout, only the patient name line differs ("Jane Doe <page>")
+    assert len(groups) == pages
+    for page_number, group in enumerate(groups, start=1):
+        lines = [words(line) for line in group]
+        assert len(lines) == 5
+        name_line = next(line for line in lines if 'Name:' in line)
+        assert sorted(name_line) == sorted(['Patient', 'Name:', 'Jane', 'Doe', str(page_number)])
+
+def test_paragraph_spanning_pages_clusters_each_page():
+    result = AnalyzeResult.from_dict(synthetic_result(2))
+    first, second = result.paragraphs[0], result.paragraphs[5]
+    # one paragraph from the first line of page 1 to the first line of page 2 (at the same y as the one of page 1)
+    first.bounding_regions = first.bounding_regions + second.bounding_regions
+    first.spans = [SimpleNamespace(offset=first.spans[0].offset, length=second.spans[0].offset + second.spans[0].length - first.spans[0].offset)]
+    lines = [sorted(words(line)) for line in renderer.render_paragraph([first], result)]
+    assert lines[0] == sorted(['Patient', 'Name:', 'Jane', 'Doe', '1'])
+    assert lines[-1] == sorted(['Patient', 'Name:', 'Jane', 'Doe', '2'])
+    assert all(line.count('Doe') <= 1 for line in lines)
+
+def test_selection_marks_are_looked_up_on_the_paragraph_page():
+    result = synthetic_result(2)
+    # a checkbox over the first paragraph of the second page only
+    paragraph = result['paragraphs'][5]
+    polygon = paragraph['bounding_regions'][0]['polygon']
+    result['pages'][1]['selection_marks'] = [{'state': 'selected', 'polygon': polygon, 'span': {'offset': paragraph['spans'][0]['offset'], 'length': 1}, 'confidence': 1.0}]
+    result = AnalyzeResult.from_dict(result)
+    first_page = ''.join(str(line) for line in renderer.render_paragraph([result.paragraphs[0]], result))
+    second_page = ''.join(str(line) for line in renderer.render_paragraph([result.paragraphs[5]], result))
+    assert 'checkbox' not in first_page
+    assert 'checked="true"' in second_page
+
+def test_element_views_are_built_once_per_page():
+    result = synthetic_result(1)
+    word = result['pages'][0]['words'][3]
+    result['pages'][0]['selection_marks'] = [{'state': 'unselected', 'polygon': word['polygon'], 'span': {'offset': 0, 'length': 1}, 'confidence': 1.0}]
+    layout = PageLayout(AnalyzeResult.from_dict(result).pages[0])
+    word, again, checkbox = layout.elements([3, 3, layout.word_count])
+    assert word.centerCoordinates is again.centerCoordinates and word.verticalInterval is again.verticalInterval
+    assert (word.centerCoordinates.X, word.centerCoordinates.Y) == tuple(layout.centers[3])
+    assert (word.verticalInterval.yMin, word.verticalInterval.yMax) == tuple(layout.y_intervals[3])
+    assert (word.span.offset, word.span.length) == (layout.span_offsets[3], layout.span_lengths[3])
+    assert word.type is ElementType.word and word.weight == 1
+    assert checkbox.type is ElementType.checkbox and checkbox.weight == 1.1 and checkbox.content == 'unselected'
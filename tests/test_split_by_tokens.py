@@ -0,0 +1,47 @@
+import pytest
+from utilities import utils, openaischeduler
+from utilities.utils import split_by_tokens
+from benchmarks.standins import StandInEncoding
+
+
+class ByteEncoding:
+    # two UTF-8 bytes per token, so tokens can end inside a character like with a BPE encoding
+    def encode(self, text):
+        data = text.encode('utf-8')
+        return [data[i:i + 2] for i in range(0, len(data), 2)]
+
+    def decode(self, tokens):
+        return b''.join(tokens).decode('utf-8', errors='replace')
+
+@pytest.fixture
+def encoding(monkeypatch):
+    def use(encoding):
+        monkeypatch.setattr(openaischeduler, 'get_encoding', lambda model: encoding)
+        monkeypatch.setattr(utils, 'get_encoding', lambda model: encoding)
+        return encoding
+    return use
+
+
+def test_lines_are_grouped_under_the_limit(encoding):
+    encoding(StandInEncoding())
+    text = ''.join(f"line {i:03d}\n" for i in range(30))
+    pieces = split_by_tokens(text, 10)
+    assert ''.join(pieces) == text
+    assert all(len(StandInEncoding().encode(piece)) <= 10 for piece in pieces)
+    assert len(pieces) == 10
+
+def test_a_long_unbroken_run_is_cut(encoding):
+    encoding(StandInEncoding())
+    run = 'x' * 4000
+    text = f"before\n{run}\nafter\n"
+    pieces = split_by_tokens(text, 100)
+    assert ''.join(pieces) == text
+    assert all(len(StandInEncoding().encode(piece)) <= 100 for piece in pieces)
+    assert pieces[0] == 'before\n' and pieces[-1] == 'after\n'
+
+def test_cuts_keep_multi_byte_characters_whole(encoding):
+    encoding(ByteEncoding())
+    run = 'é€' * 500
+    pieces = split_by_tokens(run, 7)
+    assert ''.join(pieces) == run
+    assert all('�' not in piece and len(ByteEncoding().encode(piece)) <= 7 for piece in pieces)
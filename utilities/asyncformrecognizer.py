@@ -0,0 +1,86 @@
+import os, asyncio
+from azure.core.credentials import AzureKeyCredential
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from utilities.formrecognizer import colorprint, load_cached_result, save_cached_result
+
+FR_IN_FLIGHT = int(os.getenv('FR_IN_FLIGHT', 8)) # documents analyzed at the same time
+FR_POLLING_INTERVAL = float(os.getenv('FR_POLLING_INTERVAL', 1)) # seconds between two status checks of an analysis
+
+
+class AsyncDocumentAnalyzer:
+    # One async DocumentAnalysisClient for all the documents, with up to in_flight analyses running at once.
+    # client can be any object with the same `await begin_analyze_document_from_url(...)` -> poller with
+    # `await poller.result()` interface, e.g. a local stand-in returning recorded results in tests.
+    def __init__(self, client=None, in_flight=FR_IN_FLIGHT, polling_interval=FR_POLLING_INTERVAL):
+        self.client = client
+        self.owns_client = client is None
+        self.in_flight = in_flight
+        self.polling_interval = polling_interval
+
+    async def __aenter__(self):
+        if self.client is None:
+            self.client = DocumentAnalysisClient(
+                endpoint=os.environ['FORM_RECOGNIZER_ENDPOINT'], credential=AzureKeyCredential(os.environ['FORM_RECOGNIZER_KEY'])
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.owns_client:
+            await self.client.close()
+            self.client = None
+
+    async def analyze(self, model_id, formUrl, cache_key=None):
+        # Same caching as formrecognizer.analyze_document, the cache files are read and written off the event loop
+        result = await asyncio.to_thread(load_cached_result, model_id, cache_key)
+        if result is not None:
+            colorprint(f"Found cached {model_id} result for {cache_key}, NOT sending document to Form Recognizer.",'87')
+            return result
+        poller = await self.client.begin_analyze_document_from_url(model_id, formUrl, polling_interval=self.polling_interval)
+        result = await poller.result()
+        if cache_key:
+            await asyncio.to_thread(save_cached_result, model_id, cache_key, result)
+        return result
+
+    async def analyze_many(self, model_id, files, on_result=None, on_error=None):
+        # Async iterator of (file, AnalyzeResult) in completion order, for files as returned by get_all_files
+        # ('fullpath' with a SAS token, 'cache_key'). Only in_flight files are taken from `files` at a time.
+        # A failed file goes to on_error(file, e) when given, otherwise the exception is raised.
+        files = iter(files)
+        pending = {}
+
+        def submit():
+            for file in files:
+                pending[asyncio.ensure_future(self.analyze(model_id, file['fullpath'], file.get('cache_key')))] = file
+                if len(pending) >= self.in_flight:
+                    break
+
+        submit()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    file = pending.pop(task)
+                    if task.exception() is not None:
+                        if on_error is None:
+                            raise task.exception()
+                        on_error(file, task.exception())
+                        continue
+                    if on_result is not None:
+                        on_result(file, task.result())
+                    yield file, task.result()
+                submit()
+        finally:
+            # an error, or the caller stopped iterating early: the analyses still running are abandoned
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def analyze_documents(model_id, files, on_result=None, on_error=None, client=None, in_flight=FR_IN_FLIGHT, polling_interval=FR_POLLING_INTERVAL):
+    # Blocking helper: analyze all the files with one event loop, returns {filename: AnalyzeResult}
+    async def run():
+        results = {}
+        async with AsyncDocumentAnalyzer(client, in_flight, polling_interval) as analyzer:
+            async for file, result in analyzer.analyze_many(model_id, files, on_result, on_error):
+                results[file['filename']] = result
+        return results
+    return asyncio.run(run())
@@ -1,39 +1,359 @@
-
-import os
-from datetime import datetime, timedelta
+import os, sqlite3, threading, hashlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import requests
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, generate_blob_sas, generate_container_sas, ContentSettings
+try:
+    # optional (pip install azure-storage-blob-changefeed), only used by iter_changed_files with BLOB_CHANGE_FEED
+    from azure.storage.blob.changefeed import ChangeFeedClient
+except ImportError:
+    ChangeFeedClient = None
 
-def get_all_files():
-    # Get all files in the container from Azure Blob Storage
+# e.g. the Azurite connection string (BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1), otherwise built from BLOB_ACCOUNT_NAME / BLOB_ACCOUNT_KEY
+BLOB_CONNECTION_STRING = os.getenv('BLOB_CONNECTION_STRING')
+BLOB_POOL_SIZE = int(os.getenv('BLOB_POOL_SIZE', 32)) # http connections kept open to the storage account
+BLOB_MAX_CONCURRENCY = int(os.getenv('BLOB_MAX_CONCURRENCY', 8)) # parallel blocks per upload/download
+BLOB_MAX_SINGLE_PUT_SIZE = int(os.getenv('BLOB_MAX_SINGLE_PUT_SIZE', 8 * 1024 * 1024)) # larger payloads are uploaded as staged blocks
+BLOB_MAX_BLOCK_SIZE = int(os.getenv('BLOB_MAX_BLOCK_SIZE', 4 * 1024 * 1024))
+BLOB_HASH_MISSING_MD5 = os.getenv('BLOB_HASH_MISSING_MD5', 'false').lower() == 'true' # download the blobs without Content-MD5 once to hash them, and store it on them
+
+def get_connection_string():
+    if BLOB_CONNECTION_STRING:
+        return BLOB_CONNECTION_STRING
     account_name = os.environ['BLOB_ACCOUNT_NAME']
     account_key = os.environ['BLOB_ACCOUNT_KEY']
-    connect_str = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
-    container_name = os.environ['BLOB_CONTAINER_NAME']
-    # Create the BlobServiceClient object
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    # Get files in the container
-    container_client = blob_service_client.get_container_client(container_name)
+    return f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
+
+@lru_cache(maxsize=None)
+def get_blob_service_client():
+    # One client for the whole process: every container/blob client derived from it shares
+    # the same pooled http session, so thousands of small calls don't pay a connection setup each
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=BLOB_POOL_SIZE, pool_maxsize=BLOB_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return BlobServiceClient.from_connection_string(get_connection_string(),
+        transport=RequestsTransport(session=session, session_owner=False),
+        max_single_put_size=BLOB_MAX_SINGLE_PUT_SIZE, max_block_size=BLOB_MAX_BLOCK_SIZE)
+
+def get_container_client(container_name=None):
+    return get_blob_service_client().get_container_client(container_name or os.environ['BLOB_CONTAINER_NAME'])
+
+def get_container_sas(container_name=None, hours=3):
+    container_client = get_container_client(container_name)
+    credential = container_client.credential
+    return generate_container_sas(credential.account_name, container_client.container_name, account_key=credential.account_key, permission="r", expiry=datetime.utcnow() + timedelta(hours=hours))
+
+def get_blob_sas_url(blob_name, container_name=None, hours=1):
+    container_client = get_container_client(container_name)
+    credential = container_client.credential
+    sas = generate_blob_sas(credential.account_name, container_client.container_name, blob_name, account_key=credential.account_key, permission="r", expiry=datetime.utcnow() + timedelta(hours=hours))
+    return f"{container_client.url}/{quote(blob_name)}?{sas}"
+
+def upload_file(data, blob_name, content_type='application/pdf', metadata=None, container_name=None):
+    # Payloads above BLOB_MAX_SINGLE_PUT_SIZE are staged as blocks uploaded in parallel and committed at the end.
+    # The service only computes the Content-MD5 of single puts, it is set here for the blocks too (see get_cache_keys)
+    blob_client = get_container_client(container_name).get_blob_client(blob_name)
+    content_md5 = bytearray(hashlib.md5(data).digest()) if isinstance(data, (bytes, bytearray)) else None
+    blob_client.upload_blob(data, overwrite=True, metadata=metadata, content_settings=ContentSettings(content_type=content_type, content_md5=content_md5), max_concurrency=BLOB_MAX_CONCURRENCY)
+    return get_blob_sas_url(blob_name, container_name)
+
+def upsert_blob_metadata(blob_name, metadata, container_name=None):
+    blob_client = get_container_client(container_name).get_blob_client(blob_name)
+    blob_metadata = blob_client.get_blob_properties().metadata
+    blob_metadata.update(metadata)
+    blob_client.set_blob_metadata(metadata=blob_metadata)
+
+def upsert_blobs_metadata(updates, container_name=None, max_workers=BLOB_POOL_SIZE):
+    # updates is {blob name: metadata}, returns {blob name: error} for the updates that failed
+    def upsert(item):
+        try:
+            upsert_blob_metadata(item[0], item[1], container_name)
+        except Exception as e:
+            return item[0], e
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(error for error in executor.map(upsert, updates.items()) if error)
+
+def download_stream(blob_name, container_name=None):
+    # Yields the blob content chunk by chunk instead of holding it in memory
+    blob_client = get_container_client(container_name).get_blob_client(blob_name)
+    yield from blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY).chunks()
+
+def download_file(blob_name, path, container_name=None):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        for chunk in download_stream(blob_name, container_name):
+            f.write(chunk)
+    return path
+
+def get_blob_properties(blob_name, container_name=None):
+    # None when the blob doesn't exist (anymore)
+    try:
+        return get_container_client(container_name).get_blob_client(blob_name).get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+
+def get_content_md5(blob):
+    content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+    return bytes(content_md5).hex() if content_md5 else None
+
+def hash_blob(blob, container_name=None):
+    # MD5 of a blob uploaded without one (e.g. as blocks by another tool), stored as its Content-MD5 so it is
+    # only computed once. None when it can't be done (blob changed or deleted meanwhile, no write permission...),
+    # the caller then keeps the ETag.
+    blob_client = get_container_client(container_name).get_blob_client(blob.name)
+    md5 = hashlib.md5()
+    try:
+        for chunk in blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY, etag=blob.etag, match_condition=MatchConditions.IfNotModified).chunks():
+            md5.update(chunk)
+        content_md5 = bytearray(md5.digest())
+        settings = blob.content_settings
+        blob_client.set_http_headers(ContentSettings(content_type=settings.content_type, content_encoding=settings.content_encoding,
+                                                     content_language=settings.content_language, content_disposition=settings.content_disposition,
+                                                     cache_control=settings.cache_control, content_md5=content_md5),
+                                     etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+    except HttpResponseError:
+        return None
+    settings.content_md5 = content_md5
+    return md5.hexdigest()
+
+def get_cache_keys(blobs, container_name=None):
+    # {blob name: cache key}, identifying the blob content rather than its name: its Content-MD5, else its ETag.
+    # The ETag also changes when the metadata is set (e.g. converted=true by upsert_blob_metadata), so such
+    # blobs are analyzed again; BLOB_HASH_MISSING_MD5=true hashes them once instead, which downloads them and
+    # writes their Content-MD5 (only the blobs uploaded by upload_file are sure to have one).
+    missing = [blob for blob in blobs if not get_content_md5(blob)]
+    if missing and BLOB_HASH_MISSING_MD5:
+        with ThreadPoolExecutor(max_workers=BLOB_POOL_SIZE) as executor:
+            list(executor.map(lambda blob: hash_blob(blob, container_name), missing))
+    return {blob.name: get_content_md5(blob) or blob.etag.strip('"') for blob in blobs}
+
+def get_cache_key(blob):
+    return get_cache_keys([blob])[blob.name]
+
+def get_all_files():
+    # Get all files in the container from Azure Blob Storage
+    # Get files in the container, with the shared client
+    container_client = get_container_client()
+    container_url = container_client.url
     blob_list = container_client.list_blobs(include='metadata')
     # sas = generate_blob_sas(account_name, container_name, blob.name,account_key=account_key,  permission="r", expiry=datetime.utcnow() + timedelta(hours=3))
-    sas = generate_container_sas(account_name, container_name,account_key=account_key,  permission="r", expiry=datetime.utcnow() + timedelta(hours=3))
+    sas = get_container_sas()
     files = []
+    blobs = []
     converted_files = {}
     for blob in blob_list:
         if not blob.name.startswith('converted/'):
+            blobs.append(blob)
             files.append({
                 "filename" : blob.name,
                 "converted": blob.metadata.get('converted', 'false') == 'true' if blob.metadata else False,
                 "embeddings_added": blob.metadata.get('embeddings_added', 'false') == 'true' if blob.metadata else False,
-                "fullpath": f"https://{account_name}.blob.core.windows.net/{container_name}/{blob.name}?{sas}",
-                "converted_path": ""
+                "fullpath": f"{container_url}/{blob.name}?{sas}",
+                "converted_path": "",
+                "cache_key": None
                 })
         else:
-            converted_files[blob.name] = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob.name}?{sas}"
+            converted_files[blob.name] = f"{container_url}/{blob.name}?{sas}"
 
+    cache_keys = get_cache_keys(blobs)
     for file in files:
+        file['cache_key'] = cache_keys[file['filename']]
         converted_filename = f"converted/{file['filename']}.zip"
         if converted_filename in converted_files:
             file['converted'] = True
             file['converted_path'] = converted_files[converted_filename]
     
-    return files
\ No newline at end of file
+    return files
+
+
+BLOB_MANIFEST_PATH = os.getenv('BLOB_MANIFEST_PATH', os.path.join('data', 'blob_manifest.sqlite'))
+BLOB_LIST_PAGE_SIZE = int(os.getenv('BLOB_LIST_PAGE_SIZE', 5000))
+BLOB_CHANGE_FEED = os.getenv('BLOB_CHANGE_FEED', 'auto').lower() # true, false or auto: follow the account change feed when it is enabled and azure-storage-blob-changefeed is installed
+
+class BlobManifest:
+    # Local record of the blobs seen in the container: name, ETag, last-modified, cache key, processing state
+    # (pending, done or failed) and the listing pass that last saw it, plus the sync cursors (continuation
+    # marker of an interrupted listing, current listing pass, change feed position).
+    def __init__(self, path=BLOB_MANIFEST_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, cache_key TEXT, state TEXT, listed_pass TEXT)")
+        if 'listed_pass' not in [row[1] for row in self.conn.execute("PRAGMA table_info(blobs)")]:
+            self.conn.execute("ALTER TABLE blobs ADD COLUMN listed_pass TEXT")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS markers (prefix TEXT PRIMARY KEY, marker TEXT)")
+        self.conn.commit()
+
+    def get(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT etag, cache_key, state FROM blobs WHERE name = ?", (name,)).fetchone()
+        return {'etag': row[0], 'cache_key': row[1], 'state': row[2]} if row else None
+
+    def upsert(self, name, etag, last_modified, cache_key, state='pending', listed_pass=None):
+        # listed_pass is kept when not given
+        with self.lock:
+            self.conn.execute("INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+                              "cache_key = excluded.cache_key, state = excluded.state, listed_pass = COALESCE(excluded.listed_pass, listed_pass)",
+                              (name, etag, last_modified, cache_key, state, listed_pass))
+            self.conn.commit()
+
+    def set_state(self, name, state):
+        with self.lock:
+            self.conn.execute("UPDATE blobs SET state = ? WHERE name = ?", (state, name))
+            self.conn.commit()
+
+    def delete(self, name):
+        with self.lock:
+            self.conn.execute("DELETE FROM blobs WHERE name = ?", (name,))
+            self.conn.commit()
+
+    def touch(self, names, listed_pass):
+        with self.lock:
+            self.conn.executemany("UPDATE blobs SET listed_pass = ? WHERE name = ?", [(listed_pass, name) for name in names])
+            self.conn.commit()
+
+    def delete_unlisted(self, prefix, listed_pass):
+        # forget the blobs a completed listing didn't see, they were deleted from the container
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM blobs WHERE substr(name, 1, ?) = ? AND (listed_pass IS NULL OR listed_pass != ?)", (len(prefix), prefix, listed_pass)).rowcount
+            self.conn.commit()
+        return deleted
+
+    def unfinished(self, prefix=''):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM blobs WHERE state != 'done' AND substr(name, 1, ?) = ? ORDER BY name", (len(prefix), prefix))]
+
+    def get_marker(self, prefix=''):
+        with self.lock:
+            row = self.conn.execute("SELECT marker FROM markers WHERE prefix = ?", (prefix,)).fetchone()
+        return row[0] if row else None
+
+    def set_marker(self, prefix, marker):
+        with self.lock:
+            if marker:
+                self.conn.execute("INSERT OR REPLACE INTO markers VALUES (?, ?)", (prefix, marker))
+            else:
+                self.conn.execute("DELETE FROM markers WHERE prefix = ?", (prefix,))
+            self.conn.commit()
+
+def get_change_feed_client():
+    # None when the sync has to list the container: BLOB_CHANGE_FEED=false, or auto without the package or
+    # without the change feed enabled on the storage account
+    if BLOB_CHANGE_FEED == 'false':
+        return None
+    if ChangeFeedClient is None:
+        if BLOB_CHANGE_FEED == 'true':
+            raise ImportError("BLOB_CHANGE_FEED=true needs the azure-storage-blob-changefeed package")
+        return None
+    if BLOB_CHANGE_FEED != 'true':
+        try:
+            if not get_blob_service_client().get_container_client('$blobchangefeed').exists():
+                return None
+        except HttpResponseError:
+            return None
+    return ChangeFeedClient.from_connection_string(get_connection_string())
+
+def iter_change_feed(change_feed_client, cursor, container_name, prefix=''):
+    # (blobs created, blobs deleted, cursor after them) for every page of change feed events, from a
+    # 'time:<iso datetime>' cursor or a continuation token. Only the last event of a blob in a page counts.
+    if cursor.startswith('time:'):
+        pages = change_feed_client.list_changes(start_time=datetime.fromisoformat(cursor[5:]), results_per_page=BLOB_LIST_PAGE_SIZE).by_page()
+    else:
+        pages = change_feed_client.list_changes(results_per_page=BLOB_LIST_PAGE_SIZE).by_page(continuation_token=cursor)
+    subject = f"/blobServices/default/containers/{container_name}/blobs/"
+    for page in pages:
+        changes = {}
+        for event in page:
+            if event['subject'].startswith(subject + prefix) and event['eventType'] in ('BlobCreated', 'BlobDeleted'):
+                changes[event['subject'][len(subject):]] = event['eventType']
+        yield ([name for name, event_type in changes.items() if event_type == 'BlobCreated'],
+               [name for name, event_type in changes.items() if event_type == 'BlobDeleted'],
+               pages.continuation_token or cursor)
+
+def iter_changed_files(prefix='', manifest=None):
+    # Stream the new or changed blobs (same dicts as get_all_files, without converted_path) instead of
+    # returning the whole container. Blobs left unfinished by a previous run come first, with their current
+    # properties (the deleted ones are forgotten). The other changes come from the account change feed when
+    # available (BLOB_CHANGE_FEED), after one listing on the first run; otherwise from a listing resumed from
+    # the saved continuation marker. Mark each file done/failed with manifest.set_state.
+    manifest = manifest or BlobManifest()
+    container_client = get_container_client()
+    container_url = container_client.url
+    sas = get_container_sas()
+
+    def to_file(name, cache_key, metadata=None):
+        return {
+            "filename" : name,
+            "converted": metadata.get('converted', 'false') == 'true' if metadata else False,
+            "embeddings_added": metadata.get('embeddings_added', 'false') == 'true' if metadata else False,
+            "fullpath": f"{container_url}/{name}?{sas}",
+            "converted_path": "",
+            "cache_key": cache_key
+        }
+
+    def current_blobs(names):
+        # properties of the blobs, the ones deleted meanwhile are dropped from the manifest
+        with ThreadPoolExecutor(max_workers=BLOB_POOL_SIZE) as executor:
+            properties = list(executor.map(get_blob_properties, names))
+        for name, blob in zip(names, properties):
+            if blob is None:
+                manifest.delete(name)
+        return [blob for blob in properties if blob is not None]
+
+    yielded = set()
+    def changed(blobs, listed_pass=None):
+        # the blobs whose current content isn't done, recorded as pending
+        cache_keys = get_cache_keys(blobs)
+        for blob in blobs:
+            if blob.name in yielded:
+                continue
+            cache_key = cache_keys[blob.name]
+            known = manifest.get(blob.name)
+            if known and known['cache_key'] == cache_key and known['state'] == 'done':
+                continue
+            manifest.upsert(blob.name, blob.etag, blob.last_modified.isoformat() if blob.last_modified else None, cache_key, listed_pass=listed_pass)
+            yielded.add(blob.name)
+            yield to_file(blob.name, cache_key, blob.metadata)
+
+    def listing():
+        # the blobs not seen by a completed listing (which may span several runs) were deleted
+        pass_key = f"pass:{prefix}"
+        listed_pass = manifest.get_marker(pass_key) or datetime.now(timezone.utc).isoformat()
+        manifest.set_marker(pass_key, listed_pass)
+        pages = container_client.list_blobs(name_starts_with=prefix or None, include='metadata', results_per_page=BLOB_LIST_PAGE_SIZE).by_page(continuation_token=manifest.get_marker(prefix))
+        for page in pages:
+            blobs = [blob for blob in page if not blob.name.startswith('converted/')]
+            manifest.touch([blob.name for blob in blobs], listed_pass)
+            yield from changed(blobs, listed_pass)
+            # the page was fully handed out, a restarted sync continues after it
+            manifest.set_marker(prefix, pages.continuation_token)
+        manifest.delete_unlisted(prefix, listed_pass)
+        manifest.set_marker(prefix, None)
+        manifest.set_marker(pass_key, None)
+
+    yield from changed(current_blobs(manifest.unfinished(prefix)))
+
+    change_feed_client = get_change_feed_client()
+    if change_feed_client is None:
+        yield from listing()
+        return
+    cursor_key = f"changefeed:{prefix}"
+    cursor = manifest.get_marker(cursor_key)
+    if cursor is None or cursor.startswith('listing:'):
+        # first sync: one (resumable) listing, then the changes since it started
+        start = cursor[len('listing:'):] if cursor else datetime.now(timezone.utc).isoformat()
+        manifest.set_marker(cursor_key, f"listing:{start}")
+        yield from listing()
+        manifest.set_marker(cursor_key, f"time:{start}")
+        return
+    for created, deleted, cursor in iter_change_feed(change_feed_client, cursor, container_client.container_name, prefix):
+        for name in deleted:
+            manifest.delete(name)
+        yield from changed(current_blobs([name for name in created if not name.startswith('converted/')]))
+        manifest.set_marker(cursor_key, cursor)
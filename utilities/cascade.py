@@ -0,0 +1,127 @@
+import os, re, json, time, threading
+from functools import lru_cache
+from utilities.completioncache import cached_completion
+from utilities.openaischeduler import count_tokens
+
+# e.g. [{"name": "kv", "context": "primary", "model": "gpt-35-turbo", "max_tokens": 15}, {"name": "full", "context": "full", "model": "text-davinci-003"}]
+CASCADE_TIERS = os.getenv('CASCADE_TIERS')
+CASCADE_VALIDATORS_PATH = os.getenv('CASCADE_VALIDATORS_PATH', 'validators.json') # {"<question line>": "<regex the answer must match>"}
+CASCADE_MIN_LOGPROB = os.getenv('CASCADE_MIN_LOGPROB') # mean token logprob under which an answer escalates, unset to not ask for logprobs
+CASCADE_UNKNOWN_ANSWERS = ['unknown', '']
+
+
+class Tier:
+    # One step of the cascade: which context to send (a key of the contexts passed to Cascade.ask),
+    # to which deployment, and how many tokens to let it answer with
+    def __init__(self, name, context, model, max_tokens=15, min_logprob=None):
+        self.name = name
+        self.context = context
+        self.model = model
+        self.max_tokens = max_tokens
+        self.min_logprob = min_logprob
+
+
+class CascadeStats:
+    # Per tier: questions asked, answers accepted, escalations by reason, latency and tokens
+    def __init__(self):
+        self.tiers = {}
+        self.lock = threading.Lock()
+
+    def add(self, tier, latency, prompt_tokens, completion_tokens, reason):
+        with self.lock:
+            stats = self.tiers.setdefault(tier.name, {'asked': 0, 'resolved': 0, 'escalated': {}, 'latency': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0})
+            stats['asked'] += 1
+            if reason is None:
+                stats['resolved'] += 1
+            else:
+                stats['escalated'][reason] = stats['escalated'].get(reason, 0) + 1
+            stats['latency'] += latency
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+
+    def stats(self):
+        with self.lock:
+            return {name: {
+                'asked': s['asked'],
+                'hit_rate': s['resolved'] / s['asked'] if s['asked'] else 0.0,
+                'escalated': dict(s['escalated']),
+                'mean_latency': s['latency'] / s['asked'] if s['asked'] else 0.0,
+                'tokens': s['prompt_tokens'] + s['completion_tokens'],
+                'tokens_per_question': (s['prompt_tokens'] + s['completion_tokens']) / s['asked'] if s['asked'] else 0.0
+            } for name, s in self.tiers.items()}
+
+cascade_stats = CascadeStats()
+
+
+def load_validators(path=CASCADE_VALIDATORS_PATH):
+    # {question line: compiled regex}, the question lines are matched without surrounding spaces
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {q.strip(): re.compile(pattern) for q, pattern in json.load(f).items()}
+
+def load_tiers(model='text-davinci-003', tokens_response=15):
+    # CASCADE_TIERS when set, otherwise the original behaviour: the key-value/checkbox context,
+    # then the lines and tables of the document when the answer is Unknown
+    min_logprob = float(CASCADE_MIN_LOGPROB) if CASCADE_MIN_LOGPROB else None
+    if CASCADE_TIERS:
+        return [Tier(t['name'], t['context'], t.get('model', model), t.get('max_tokens', tokens_response), t.get('min_logprob', min_logprob))
+                for t in json.loads(CASCADE_TIERS)]
+    return [Tier('primary', 'primary', model, tokens_response, min_logprob), Tier('secondary', 'secondary', model, tokens_response, min_logprob)]
+
+def get_mean_logprob(response):
+    logprobs = (response['choices'][0].get('logprobs') or {}).get('token_logprobs') or []
+    logprobs = [l for l in logprobs if l is not None]
+    return sum(logprobs) / len(logprobs) if logprobs else None
+
+
+class Cascade:
+    def __init__(self, tiers, validators=None, stats=cascade_stats):
+        self.tiers = tiers
+        self.validators = load_validators() if validators is None else validators
+        self.stats = stats
+
+    def escalation_reason(self, tier, question, answer, response=None):
+        # None when the answer is accepted
+        if answer.lower() in CASCADE_UNKNOWN_ANSWERS:
+            return 'unknown'
+        validator = self.validators.get(question.strip())
+        if validator is not None and not validator.fullmatch(answer):
+            return 'invalid'
+        if tier.min_logprob is not None and response is not None:
+            mean_logprob = get_mean_logprob(response)
+            if mean_logprob is not None and mean_logprob < tier.min_logprob:
+                return 'low_logprob'
+        return None
+
+    def ask(self, contexts, instruction, question, temperature=0, restart_sequence='\n\n', first_tier=0):
+        # Ask the tiers in order until one answer is accepted, tiers whose context is empty are skipped
+        # (except the last one). Returns [(tier name, answer), ...] of the tiers asked, the last answer is the result.
+        attempts = []
+        for i, tier in enumerate(self.tiers[first_tier:], start=first_tier):
+            context = contexts.get(tier.context, '')
+            if not context and i < len(self.tiers) - 1:
+                continue
+            prompt = f"{context}{restart_sequence}{instruction}{''+question}"
+            # same parameters as utils.complete_prompt, so both share the completion cache
+            params = dict(engine=tier.model, prompt=prompt, temperature=temperature, max_tokens=tier.max_tokens,
+                          top_p=0.5, frequency_penalty=0, presence_penalty=0, stop=None)
+            if tier.min_logprob is not None:
+                params['logprobs'] = 1
+            start = time.perf_counter()
+            response = cached_completion(**params)
+            latency = time.perf_counter() - start
+            answer = response['choices'][0]['text'].strip(' \n:?')
+            usage = response.get('usage') or {}
+            prompt_tokens = usage['prompt_tokens'] if 'prompt_tokens' in usage else count_tokens(prompt, tier.model)
+            reason = self.escalation_reason(tier, question, answer, response)
+            self.stats.add(tier, latency, prompt_tokens, usage.get('completion_tokens', 0), reason)
+            attempts.append((tier.name, answer))
+            if reason is None:
+                break
+        return attempts
+
+
+@lru_cache(maxsize=None)
+def get_default_cascade(model='text-davinci-003', tokens_response=15):
+    return Cascade(load_tiers(model, tokens_response))
@@ -0,0 +1,157 @@
+import os, json, time, atexit, hashlib, sqlite3, threading
+from redis import Redis
+from utilities.openaischeduler import get_scheduler
+
+COMPLETION_CACHE = os.getenv('COMPLETION_CACHE', 'sqlite') # sqlite, redis or none
+COMPLETION_CACHE_PATH = os.getenv('COMPLETION_CACHE_PATH', os.path.join('data', 'completion_cache.sqlite'))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv('COMPLETION_CACHE_MAX_ENTRIES', 100000))
+COMPLETION_CACHE_TTL = int(os.getenv('COMPLETION_CACHE_TTL', 0)) # seconds, 0 means entries never expire
+COMPLETION_CACHE_EVICT_BATCH = int(os.getenv('COMPLETION_CACHE_EVICT_BATCH', 1000)) # entries evicted at once when the cache is full
+COMPLETION_CACHE_TOUCH_BATCH = int(os.getenv('COMPLETION_CACHE_TOUCH_BATCH', 100)) # hits between two writes of their last use
+# only deterministic (temperature 0) completions are cached unless this is set
+COMPLETION_CACHE_ALL_TEMPERATURES = os.getenv('COMPLETION_CACHE_ALL_TEMPERATURES', 'false').lower() == 'true'
+
+CACHE_KEY_FIELDS = ['engine', 'prompt', 'temperature', 'top_p', 'max_tokens', 'frequency_penalty', 'presence_penalty', 'stop', 'logprobs']
+
+
+def get_cache_key(**kwargs):
+    key_data = {k: kwargs.get(k) for k in CACHE_KEY_FIELDS}
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SQLiteCompletionStore:
+    # Least recently used entries are evicted in batches once the cache is over max_entries. A hit doesn't
+    # commit: the last_used updates are written with the next insert, every touch_batch hits, or on exit.
+    def __init__(self, path=COMPLETION_CACHE_PATH, max_entries=COMPLETION_CACHE_MAX_ENTRIES, ttl=COMPLETION_CACHE_TTL,
+                 evict_batch=COMPLETION_CACHE_EVICT_BATCH, touch_batch=COMPLETION_CACHE_TOUCH_BATCH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_batch = max(1, min(evict_batch, max_entries))
+        self.touch_batch = touch_batch
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response TEXT, created REAL, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        self.touched = {} # key: last_used not written yet
+        self.touched_hits = 0
+        atexit.register(self.flush)
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and row[1] < time.time() - self.ttl:
+                self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.conn.commit()
+                self.size -= 1
+                self.touched.pop(key, None)
+                return None
+            self.touched[key] = time.time()
+            self.touched_hits += 1
+            if self.touched_hits >= self.touch_batch:
+                self.write_touched()
+                self.conn.commit()
+            return json.loads(row[0])
+
+    def set(self, key, response):
+        now = time.time()
+        with self.lock:
+            data = json.dumps(response)
+            if self.conn.execute("INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?)", (key, data, now, now)).rowcount:
+                self.size += 1
+            else:
+                self.conn.execute("UPDATE completions SET response = ?, created = ?, last_used = ? WHERE key = ?", (data, now, now, key))
+            self.touched.pop(key, None)
+            if self.size > self.max_entries:
+                # down to evict_batch entries below the limit, so the next inserts don't evict again
+                self.write_touched()
+                self.size -= self.conn.execute("DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used LIMIT ?)",
+                                               (self.size - self.max_entries + self.evict_batch,)).rowcount
+            self.conn.commit()
+
+    def write_touched(self):
+        if self.touched:
+            self.conn.executemany("UPDATE completions SET last_used = ? WHERE key = ?", [(t, k) for k, t in self.touched.items()])
+            self.touched.clear()
+        self.touched_hits = 0
+
+    def flush(self):
+        with self.lock:
+            self.write_touched()
+            self.conn.commit()
+
+
+class RedisCompletionStore:
+    def __init__(self, prefix='completion', max_entries=COMPLETION_CACHE_MAX_ENTRIES, ttl=COMPLETION_CACHE_TTL):
+        self.redis_conn = Redis(host= os.environ.get('REDIS_ADDRESS','localhost'), port=6379, password=os.environ.get('REDIS_PASSWORD',None))
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, key):
+        response = self.redis_conn.get(f"{self.prefix}:{key}")
+        if response is None:
+            return None
+        self.redis_conn.zadd(f"{self.prefix}-lru", {key: time.time()})
+        return json.loads(response)
+
+    def set(self, key, response):
+        pipe = self.redis_conn.pipeline()
+        pipe.set(f"{self.prefix}:{key}", json.dumps(response), ex=self.ttl or None)
+        pipe.zadd(f"{self.prefix}-lru", {key: time.time()})
+        pipe.zcard(f"{self.prefix}-lru")
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            evicted = self.redis_conn.zpopmin(f"{self.prefix}-lru", size - self.max_entries)
+            self.redis_conn.delete(*[f"{self.prefix}:{k.decode('utf-8')}" for k, _ in evicted])
+
+
+class CompletionCache:
+    def __init__(self, store=None):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        # Drop-in replacement for openai.Completion.create, misses go through the quota scheduler
+        if self.store is None or (kwargs.get('temperature', 1) != 0 and not COMPLETION_CACHE_ALL_TEMPERATURES):
+            return get_scheduler().completion(**kwargs)
+        key = get_cache_key(**kwargs)
+        response = self.store.get(key)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if response is None:
+            response = get_scheduler().completion(**kwargs)
+            self.store.set(key, response)
+        return response
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            if COMPLETION_CACHE == 'sqlite':
+                _completion_cache = CompletionCache(SQLiteCompletionStore())
+            elif COMPLETION_CACHE == 'redis':
+                _completion_cache = CompletionCache(RedisCompletionStore())
+            else:
+                _completion_cache = CompletionCache()
+        return _completion_cache
+
+def cached_completion(**kwargs):
+    return get_completion_cache().create(**kwargs)
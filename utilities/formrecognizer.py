@@ -1,6 +1,10 @@
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.formrecognizer import DocumentAnalysisClient
-import os
+from azure.core.exceptions import HttpResponseError
+from azure.ai.formrecognizer import DocumentAnalysisClient, AnalyzeResult
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os, json, heapq, tempfile
+from utilities.instrumentation import instrumented, text_bytes
 
 
 def colorprint(txt,opt="222",end='\n'): 
@@ -9,17 +13,118 @@ def colorprint(txt,opt="222",end='\n'):
 
 PAGES_PER_EMBEDDINGS = int(os.getenv('PAGES_PER_EMBEDDINGS', 2))
 SECTION_TO_EXCLUDE = ['title', 'sectionHeading', 'footnote', 'pageHeader', 'pageFooter', 'pageNumber']
+FR_CACHE_DIR = os.getenv('FR_CACHE_DIR', os.path.join('data', 'fr_cache'))
+FR_SHARD_PAGES = int(os.getenv('FR_SHARD_PAGES', 0)) # pages per shard of a long document, 0 analyzes documents in one piece
+FR_SHARD_CONCURRENCY = int(os.getenv('FR_SHARD_CONCURRENCY', 4)) # shards analyzed at the same time
 
-def analyze_read(formUrl,verbose =False ):
+def get_cache_path(model_id, cache_key):
+    return os.path.join(FR_CACHE_DIR, model_id, f"{cache_key}.json")
 
-    
-    document_analysis_client = DocumentAnalysisClient(
+def load_cached_result(model_id, cache_key):
+    # Rebuild the full AnalyzeResult stored for this blob content and model, None if not cached
+    if not cache_key:
+        return None
+    try:
+        with open(get_cache_path(model_id, cache_key)) as f:
+            return AnalyzeResult.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+
+def save_cached_result(model_id, cache_key, result):
+    cache_path = get_cache_path(model_id, cache_key)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # a temporary file of its own: threads analyzing copies of the same content write the same cache path
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(result.to_dict(), f)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+@lru_cache(maxsize=None)
+def get_document_analysis_client():
+    return DocumentAnalysisClient(
         endpoint=os.environ['FORM_RECOGNIZER_ENDPOINT'], credential=AzureKeyCredential(os.environ['FORM_RECOGNIZER_KEY'])
     )
-    
-    poller = document_analysis_client.begin_analyze_document_from_url(
-            "prebuilt-layout", formUrl)
-    layout = poller.result()
+
+def analyze_document(model_id, formUrl, cache_key=None, shard_pages=FR_SHARD_PAGES):
+    # cache_key identifies the blob content (MD5 or ETag, see azureblobstorage.get_cache_key),
+    # so a re-uploaded blob is analyzed again and a renamed one is served from the cache.
+    result = load_cached_result(model_id, cache_key)
+    if result is not None:
+        colorprint(f"Found cached {model_id} result for {cache_key}, NOT sending document to Form Recognizer.",'87')
+        return result
+
+    colorprint(f"Sending the document to Form Recognizer ({model_id}) to extract content",'87')
+    if shard_pages:
+        result = analyze_document_shards(model_id, formUrl, shard_pages)
+    else:
+        poller = get_document_analysis_client().begin_analyze_document_from_url(
+                model_id, formUrl)
+        result = poller.result()
+    if cache_key:
+        save_cached_result(model_id, cache_key, result)
+    return result
+
+def analyze_document_shards(model_id, formUrl, shard_pages, concurrency=FR_SHARD_CONCURRENCY):
+    # The page count is not known before the analysis: the first range of shard_pages pages is analyzed
+    # alone, documents that fit in it (most of them) take one request. Longer ones continue with waves of
+    # `concurrency` ranges, until a range comes back short or past the last page.
+    client = get_document_analysis_client()
+
+    def analyze_shard(first_page):
+        try:
+            poller = client.begin_analyze_document_from_url(model_id, formUrl, pages=f"{first_page}-{first_page + shard_pages - 1}")
+            return poller.result()
+        except HttpResponseError as e:
+            # a range starting after the last page is rejected as an invalid parameter
+            if first_page > 1 and e.status_code == 400:
+                return None
+            raise
+
+    shards = [analyze_shard(1)]
+    if len(shards[0].pages) < shard_pages:
+        return shards[0]
+    first_page = shard_pages + 1
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            wave = list(executor.map(analyze_shard, range(first_page, first_page + concurrency * shard_pages, shard_pages)))
+            shards.extend(shard for shard in wave if shard is not None)
+            if any(shard is None or len(shard.pages) < shard_pages for shard in wave):
+                break
+            first_page += concurrency * shard_pages
+    return merge_results(shards)
+
+def merge_results(results):
+    # One AnalyzeResult from the results of consecutive page ranges. Page numbers are already those of the
+    # whole document, the contents are joined and the spans of each shard shifted by the content before it.
+    if len(results) == 1:
+        return results[0]
+    merged = results[0].to_dict()
+    for result in results[1:]:
+        shard = result.to_dict()
+        shift_spans(shard, len(merged['content']) + 1)
+        merged['content'] = f"{merged['content']}\n{shard['content']}"
+        for key in ['pages', 'paragraphs', 'tables', 'key_value_pairs', 'styles', 'languages', 'documents']:
+            merged[key] = (merged.get(key) or []) + (shard.get(key) or [])
+    return AnalyzeResult.from_dict(merged)
+
+def shift_spans(element, shift):
+    if isinstance(element, list):
+        for e in element:
+            shift_spans(e, shift)
+    elif isinstance(element, dict):
+        if 'offset' in element and 'length' in element:
+            element['offset'] += shift
+        for value in element.values():
+            if isinstance(value, (list, dict)):
+                shift_spans(value, shift)
+
+@instrumented('analyze_read', lambda chunks, *args, **kwargs: {'bytes': text_bytes(chunks)})
+def analyze_read(formUrl,verbose =False, cache_key=None, shard_pages=FR_SHARD_PAGES):
+    layout = analyze_document("prebuilt-layout", formUrl, cache_key, shard_pages)
 
     if verbose:
         print('Extracted dictionary with keys: ', end='')
@@ -27,40 +132,77 @@ def analyze_read(formUrl,verbose =False ):
         print('EXTRACTING:')
 
     results = []
-    page_result = ''
     if verbose:print('paragraphs')
     for p in layout.paragraphs:
         if verbose:print('.',end='')
-        page_number = p.bounding_regions[0].page_number
-        output_file_id = int((page_number - 1 ) / PAGES_PER_EMBEDDINGS)
+        output_file_id = get_output_file_id(p)
 
-        if len(results) < output_file_id + 1:
-            results.append('')
+        while len(results) < output_file_id + 1:
+            results.append([])
 
         if p.role not in SECTION_TO_EXCLUDE:
-            results[output_file_id] += f"{p.content}\n"
+            results[output_file_id].append(f"{p.content}\n")
     if verbose:print('\ntables')
     for t in layout.tables:
         if verbose:print('.',end='')
-        page_number = t.bounding_regions[0].page_number
-        output_file_id = int((page_number - 1 ) / PAGES_PER_EMBEDDINGS)
+        output_file_id = get_output_file_id(t)
         
-        if len(results) < output_file_id + 1:
-            results.append('')
-        previous_cell_row=0
-        rowcontent='| '
-        tablecontent = ''
-        for c in t.cells:
-            if c.row_index == previous_cell_row:
-                rowcontent +=  c.content + " | "
-            else:
-                tablecontent += rowcontent + "\n"
-                rowcontent='|'
-                rowcontent += c.content + " | "
-                previous_cell_row += 1
-        results[output_file_id] += f"{tablecontent}|"
+        while len(results) < output_file_id + 1:
+            results.append([])
+        results[output_file_id].append(f"{format_table_content(t)}|")
     if verbose:print()
-    return results
+    return [''.join(r) for r in results]
+
+def analyze_read_stream(formUrl,verbose =False, cache_key=None, shard_pages=FR_SHARD_PAGES):
+    # Same as analyze_read, but yields the PAGES_PER_EMBEDDINGS chunks one at a time
+    layout = analyze_document("prebuilt-layout", formUrl, cache_key, shard_pages)
+    yield from iter_layout_chunks(layout, verbose)
+
+def iter_layout_chunks(layout, verbose=False):
+    # Yield the text of each PAGES_PER_EMBEDDINGS chunk as soon as it is complete, in page order
+    # (an empty string for chunks without content), with paragraphs and tables in reading order.
+    def paragraphs():
+        for p in layout.paragraphs:
+            if p.role not in SECTION_TO_EXCLUDE:
+                yield get_position(p), f"{p.content}\n"
+    def tables():
+        for t in layout.tables:
+            yield get_position(t), t
+
+    output_file_id = 0
+    chunk = []
+    for (page_number, _), item in heapq.merge(paragraphs(), tables(), key=lambda x: x[0]):
+        item_file_id = int((page_number - 1 ) / PAGES_PER_EMBEDDINGS)
+        while output_file_id < item_file_id:
+            if verbose:print(f"chunk {output_file_id}")
+            yield ''.join(chunk)
+            chunk = []
+            output_file_id += 1
+        chunk.append(item if isinstance(item, str) else f"{format_table_content(item)}|")
+    if chunk:
+        if verbose:print(f"chunk {output_file_id}")
+        yield ''.join(chunk)
+
+def get_position(element):
+    # (page number, offset in the document content) of a paragraph or table
+    return element.bounding_regions[0].page_number, element.spans[0].offset if element.spans else 0
+
+def get_output_file_id(element):
+    page_number = element.bounding_regions[0].page_number
+    return int((page_number - 1 ) / PAGES_PER_EMBEDDINGS)
+
+def format_table_content(t):
+    rows = []
+    rowcontent = ['| ']
+    previous_cell_row=0
+    for c in t.cells:
+        if c.row_index == previous_cell_row:
+            rowcontent.append(c.content + " | ")
+        else:
+            rows.append(''.join(rowcontent) + "\n")
+            rowcontent = ['|', c.content + " | "]
+            previous_cell_row += 1
+    return ''.join(rows)
 #_____________________________________________________________________________________________________________________________
 
 def format_table(t):
@@ -70,18 +212,7 @@ def format_table(t):
         
         if len(results) < output_file_id + 1:
             results.append('')
-        previous_cell_row=0
-        rowcontent='| '
-        tablecontent = ''
-        for c in t.cells:
-            if c.row_index == previous_cell_row:
-                rowcontent +=  c.content + " | "
-            else:
-                tablecontent += rowcontent + "\n"
-                rowcontent='|'
-                rowcontent += c.content + " | "
-                previous_cell_row += 1
-        results[output_file_id] += f"{tablecontent}|"
+        results[output_file_id] += f"{format_table_content(t)}|"
     
         return results
 
@@ -98,16 +229,12 @@ def format_polygon(polygon):
 
 
 
-def analyze_general_documents(docUrl,verbose=False):
+@instrumented('analyze_general_documents', lambda result, *args, **kwargs: {'bytes': text_bytes(result[2])})
+def analyze_general_documents(docUrl,verbose=False, cache_key=None):
     print(docUrl)
     kv_results=[]
     kv_dict={}
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=os.environ['FORM_RECOGNIZER_ENDPOINT'], credential=AzureKeyCredential(os.environ['FORM_RECOGNIZER_KEY'])
-    )
-    poller = document_analysis_client.begin_analyze_document_from_url(
-            "prebuilt-document", docUrl)
-    result = poller.result()
+    result = analyze_document("prebuilt-document", docUrl, cache_key)
 
     for style in result.styles:
         if style.is_handwritten:
@@ -0,0 +1,201 @@
+import os, re, json, time, tempfile, threading, itertools, functools, cProfile, tracemalloc
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+METRICS_LOG_PATH = os.getenv('METRICS_LOG_PATH', '') # append one JSON line per measured call to this file (e.g. data/metrics.jsonl), empty to disable
+METRICS_PROMETHEUS_PATH = os.getenv('METRICS_PROMETHEUS_PATH', os.path.join('data', 'metrics.prom')) # written by write_metrics()
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # serve /metrics in the Prometheus text format, 0 to disable
+PROFILE_DOCUMENTS = os.getenv('PROFILE_DOCUMENTS', 'false').lower() == 'true' # cProfile + memory use of the documents, one profiled at a time
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join('data', 'profiles'))
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+COUNTERS = ['retries', 'prompt_tokens', 'completion_tokens', 'bytes']
+
+
+class Metrics:
+    # Totals per stage (analyze_read, translate, embedding, completion, ...): calls, errors, wall time
+    # with a latency histogram, and the counters a call reports (retries, tokens, bytes)
+    def __init__(self, log_path=METRICS_LOG_PATH):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.log_path = log_path
+        self.log = None
+
+    def get_stage(self, stage):
+        return self.stages.setdefault(stage, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS), **{c: 0 for c in COUNTERS}})
+
+    def add(self, stage, **counts):
+        # counters outside of a measured call, e.g. the retries of a tenacity decorator
+        with self.lock:
+            stats = self.get_stage(stage)
+            for name in COUNTERS:
+                stats[name] += counts.get(name) or 0
+
+    def record(self, stage, seconds, error=None, **counts):
+        with self.lock:
+            stats = self.get_stage(stage)
+            stats['calls'] += 1
+            stats['errors'] += error is not None
+            stats['seconds'] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            for name in COUNTERS:
+                stats[name] += counts.get(name) or 0
+            if self.log_path:
+                if self.log is None:
+                    os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+                    self.log = open(self.log_path, 'a', buffering=1)
+                entry = {'time': time.time(), 'stage': stage, 'seconds': round(seconds, 6), **{k: v for k, v in counts.items() if v is not None}}
+                if error is not None:
+                    entry['error'] = repr(error)
+                self.log.write(json.dumps(entry) + '\n')
+
+    def stats(self):
+        with self.lock:
+            return {stage: {k: v for k, v in s.items() if k != 'buckets'} for stage, s in self.stages.items()}
+
+    def prometheus_text(self):
+        lines = []
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            stages = {stage: dict(s, buckets=list(s['buckets'])) for stage, s in self.stages.items()}
+        metric('qna_stage_calls_total', 'counter', 'Calls per stage.')
+        lines += [f'qna_stage_calls_total{{stage="{stage}"}} {s["calls"]}' for stage, s in stages.items()]
+        metric('qna_stage_errors_total', 'counter', 'Calls per stage that raised.')
+        lines += [f'qna_stage_errors_total{{stage="{stage}"}} {s["errors"]}' for stage, s in stages.items()]
+        metric('qna_stage_seconds', 'histogram', 'Wall time per call.')
+        for stage, s in stages.items():
+            lines += [f'qna_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}' for bound, count in zip(LATENCY_BUCKETS, s['buckets'])]
+            lines.append(f'qna_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {s["calls"]}')
+            lines.append(f'qna_stage_seconds_sum{{stage="{stage}"}} {s["seconds"]}')
+            lines.append(f'qna_stage_seconds_count{{stage="{stage}"}} {s["calls"]}')
+        for name in COUNTERS:
+            metric(f'qna_stage_{name}_total', 'counter', f"{name.replace('_', ' ').capitalize()} per stage.")
+            lines += [f'qna_stage_{name}_total{{stage="{stage}"}} {s[name]}' for stage, s in stages.items()]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=METRICS_PROMETHEUS_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+metrics = Metrics()
+
+
+@contextmanager
+def measure(stage):
+    # with measure('completion') as counts: ... counts['prompt_tokens'] = ...
+    counts = {}
+    start = time.perf_counter()
+    try:
+        yield counts
+    except BaseException as e:
+        metrics.record(stage, time.perf_counter() - start, error=e, **counts)
+        raise
+    metrics.record(stage, time.perf_counter() - start, **counts)
+
+def instrumented(stage, count=None):
+    # Decorator measuring every call; count(result, *args, **kwargs) returns the counters of the call, e.g. {'bytes': ...}
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(stage) as counts:
+                result = function(*args, **kwargs)
+                if count is not None:
+                    counts.update(count(result, *args, **kwargs))
+                return result
+        return wrapper
+    return decorator
+
+def count_retry(stage):
+    # before_sleep callback of tenacity's @retry
+    return lambda retry_state: metrics.add(stage, retries=1)
+
+def text_bytes(text):
+    if isinstance(text, (list, tuple)):
+        return sum(text_bytes(t) for t in text)
+    return len(text.encode('utf-8')) if isinstance(text, str) else 0
+
+
+profile_lock = threading.Lock()
+profile_sequence = itertools.count(1)
+
+def get_rss():
+    # resident set size of the process in bytes, None where /proc isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextmanager
+def profile_document(name, enabled=PROFILE_DOCUMENTS):
+    # Opt-in (PROFILE_DOCUMENTS=true): cProfile of the thread processing the document, written to
+    # PROFILE_DIR/<pid>-<sequence>-<name>.prof, and its memory use in the metrics log.
+    # Only one profiler can be active at a time (Python 3.12+ raises otherwise): the documents starting
+    # while another one is profiled run unprofiled rather than waiting for it. RSS and tracemalloc are
+    # process wide, so the memory numbers also include what the other workers allocated meanwhile.
+    if not enabled or not profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        rss_before = get_rss()
+        memory_before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            memory_after, memory_peak = tracemalloc.get_traced_memory()
+            rss_after = get_rss()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            # the whole blob name and a sequence number, so documents with the same base name or processed twice don't overwrite each other
+            file_name = re.sub(r'[^\w.-]', '_', name)
+            profile_path = os.path.join(PROFILE_DIR, f"{os.getpid()}-{next(profile_sequence):05d}-{file_name}.prof")
+            profiler.dump_stats(profile_path)
+            metrics.record('document', time.perf_counter() - start, document=name, profile=profile_path,
+                           rss_delta_bytes=rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+                           traced_delta_bytes=memory_after - memory_before, peak_memory=memory_peak)
+    finally:
+        profile_lock.release()
+
+
+def start_metrics_server(port=METRICS_PORT):
+    # Prometheus scrape endpoint on http://<host>:<port>/metrics, in a daemon thread
+    if not port:
+        return None
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_metrics(path=METRICS_PROMETHEUS_PATH):
+    if path:
+        metrics.write_prometheus(path)
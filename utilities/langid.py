@@ -0,0 +1,77 @@
+import os, re, math, glob
+from collections import Counter
+from functools import lru_cache
+
+LANGID_SAMPLES_DIR = os.getenv('LANGID_SAMPLES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'langsamples'))
+LANGID_NGRAM_ORDER = int(os.getenv('LANGID_NGRAM_ORDER', 3))
+LANGID_MIN_LETTERS = int(os.getenv('LANGID_MIN_LETTERS', 40)) # shorter texts are always uncertain
+LANGID_MAX_CHARS = int(os.getenv('LANGID_MAX_CHARS', 4000)) # only the beginning of long texts is scored
+LANGID_MIN_COVERAGE = float(os.getenv('LANGID_MIN_COVERAGE', 0.6)) # share of the text trigrams known by the detected language
+LANGID_CONFIDENCE_LETTERS = float(os.getenv('LANGID_CONFIDENCE_LETTERS', 20)) # the scores are scaled to this many letters for the confidence
+
+NON_LETTERS = re.compile(r"[^\w']+|[\d_]+")
+
+
+def get_ngrams(text, order=LANGID_NGRAM_ORDER):
+    # Character n-grams of 1..order letters, words padded with spaces; digits and punctuation are ignored
+    ngrams = Counter()
+    for word in NON_LETTERS.sub(' ', text[:LANGID_MAX_CHARS].lower()).split():
+        word = f" {word} "
+        for n in range(1, order + 1):
+            for i in range(len(word) - n + 1):
+                ngrams[word[i:i + n]] += 1
+    ngrams.pop(' ', None)
+    return ngrams
+
+
+class LanguageIdentifier:
+    # Naive Bayes over character n-grams: each language profile holds the add-one smoothed log-probability
+    # of its n-grams, detect returns the most likely language and a confidence. The n-grams of a text overlap,
+    # so the plain posterior is 1.0 after a few words whatever the margin; the confidence is the posterior of
+    # the scores scaled to LANGID_CONFIDENCE_LETTERS letters, i.e. it depends on the margin per letter over
+    # the other languages, not on the length (0.99 takes a margin of about 0.23 per letter).
+    def __init__(self, samples):
+        self.profiles = {}
+        self.unseen = {}
+        for language, text in samples.items():
+            ngrams = get_ngrams(text)
+            total = sum(ngrams.values()) + len(ngrams) + 1
+            self.profiles[language] = {ngram: math.log((count + 1) / total) for ngram, count in ngrams.items()}
+            self.unseen[language] = math.log(1 / total)
+
+    @classmethod
+    def from_samples(cls, path=LANGID_SAMPLES_DIR):
+        # one <language code>.txt file of sample text per language
+        samples = {}
+        for file_name in sorted(glob.glob(os.path.join(path, '*.txt'))):
+            with open(file_name, encoding='utf-8') as f:
+                samples[os.path.splitext(os.path.basename(file_name))[0]] = f.read()
+        return cls(samples)
+
+    def scores(self, ngrams):
+        return {language: sum(profile.get(ngram, self.unseen[language]) * count for ngram, count in ngrams.items())
+                for language, profile in self.profiles.items()}
+
+    def detect(self, text):
+        ngrams = get_ngrams(text)
+        letters = sum(count for ngram, count in ngrams.items() if len(ngram) == 1)
+        if letters < LANGID_MIN_LETTERS:
+            return None, 0.0
+        scores = self.scores(ngrams)
+        language = max(scores, key=scores.get)
+        # texts mostly made of n-grams no profile knows are in a language we have no sample for
+        trigrams = {ngram: count for ngram, count in ngrams.items() if len(ngram) == LANGID_NGRAM_ORDER}
+        known = sum(count for ngram, count in trigrams.items() if ngram in self.profiles[language])
+        if trigrams and known / sum(trigrams.values()) < LANGID_MIN_COVERAGE:
+            return None, 0.0
+        scale = LANGID_CONFIDENCE_LETTERS / letters
+        confidence = 1 / sum(math.exp((score - scores[language]) * scale) for score in scores.values())
+        return language, confidence
+
+
+@lru_cache(maxsize=None)
+def get_language_identifier():
+    return LanguageIdentifier.from_samples()
+
+def detect_language(text):
+    return get_language_identifier().detect(text)
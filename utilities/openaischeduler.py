@@ -0,0 +1,182 @@
+import os, time, random, asyncio, threading
+from collections import deque
+from functools import lru_cache
+import openai
+import tiktoken
+from utilities.instrumentation import measure
+
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', 120000)) # tokens per minute of the deployment
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', 720)) # requests per minute of the deployment
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 6))
+OPENAI_MAX_BACKOFF = float(os.getenv('OPENAI_MAX_BACKOFF', 60))
+
+RETRIABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    # deployment names are free text, fall back to the davinci-003 encoding when tiktoken doesn't know them
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('p50k_base')
+
+def count_tokens(text, model='text-davinci-003'):
+    return len(get_encoding(model).encode(text))
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # seconds until `amount` is available, assumes refill() was just called
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class OpenAIScheduler:
+    # Token buckets for the TPM and RPM quota, shared by all threads and async tasks of the process.
+    def __init__(self, tpm=OPENAI_TPM_LIMIT, rpm=OPENAI_RPM_LIMIT, max_retries=OPENAI_MAX_RETRIES):
+        self.token_bucket = TokenBucket(tpm)
+        self.request_bucket = TokenBucket(rpm)
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.paused_until = 0.0 # set by a 429, every caller waits for it
+        self.history = deque() # (time, tokens) of the requests sent in the last minute
+        self.rate_limited = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0 # time the quota was paused by 429s, each pause counted once
+        self.waited_seconds = 0.0 # time each caller spent waiting for the quota, summed over the callers
+
+    def reserve(self, cost):
+        # Take `cost` tokens and one request if both are available, otherwise return the seconds to wait
+        cost = min(cost, self.token_bucket.capacity)
+        with self.lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if wait <= 0:
+                self.token_bucket.refill(now)
+                self.request_bucket.refill(now)
+                wait = max(self.token_bucket.wait_time(cost), self.request_bucket.wait_time(1))
+            if wait > 0:
+                return wait
+            self.token_bucket.tokens -= cost
+            self.request_bucket.tokens -= 1
+            self.history.append((now, cost))
+            return 0.0
+
+    def acquire(self, cost):
+        start = time.monotonic()
+        while True:
+            wait = self.reserve(cost)
+            if wait <= 0:
+                return self.add_wait(start)
+            time.sleep(wait)
+
+    async def acquire_async(self, cost):
+        start = time.monotonic()
+        while True:
+            wait = self.reserve(cost)
+            if wait <= 0:
+                return self.add_wait(start)
+            await asyncio.sleep(wait)
+
+    def add_wait(self, start):
+        # once per acquire, however many times the caller polled reserve()
+        waited = time.monotonic() - start
+        if waited > 0:
+            with self.lock:
+                self.waited_seconds += waited
+
+    def backoff(self, error, attempt):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # the pause itself is exact, only the callers resuming after it are staggered,
+            # by a jitter in proportion to the delay so a short Retry-After stays short
+            pause = retry_after
+            delay = retry_after + random.uniform(0, min(1, 0.1 * retry_after))
+        else:
+            pause = delay = random.uniform(0, min(OPENAI_MAX_BACKOFF, 2 ** attempt))
+        with self.lock:
+            self.retries += 1
+            if isinstance(error, openai.error.RateLimitError):
+                self.rate_limited += 1
+                # the quota is shared, so make every caller wait, not only this one
+                now = time.monotonic()
+                paused_until = max(self.paused_until, now + pause)
+                # only the part of the pause not already covered by an earlier 429
+                self.throttled_seconds += paused_until - max(self.paused_until, now)
+                self.paused_until = paused_until
+        return delay
+
+    def completion(self, **kwargs):
+        # Drop-in replacement for openai.Completion.create
+        cost = count_tokens(kwargs.get('prompt', ''), kwargs.get('engine', 'text-davinci-003')) + kwargs.get('max_tokens', 16)
+        with measure('completion') as counts:
+            for attempt in range(self.max_retries + 1):
+                self.acquire(cost)
+                try:
+                    response = openai.Completion.create(**kwargs)
+                except RETRIABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    counts['retries'] = attempt + 1
+                    time.sleep(self.backoff(e, attempt))
+                    continue
+                usage = response.get('usage') or {}
+                counts.update(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'), model=kwargs.get('engine'))
+                return response
+
+    def utilization(self):
+        # share of the TPM/RPM quota used in the last minute, close to 1.0 means concurrency can't go higher
+        with self.lock:
+            now = time.monotonic()
+            while self.history and self.history[0][0] < now - 60:
+                self.history.popleft()
+            tokens = sum(cost for _, cost in self.history)
+            return {
+                'tpm': tokens / self.token_bucket.capacity,
+                'rpm': len(self.history) / self.request_bucket.capacity,
+                'rate_limited': self.rate_limited,
+                'retries': self.retries,
+                'throttled_seconds': round(self.throttled_seconds, 1),
+                'waited_seconds': round(self.waited_seconds, 1),
+            }
+
+
+def get_retry_after(error):
+    headers = getattr(error, 'headers', None) or {}
+    for name in ('retry-after-ms', 'Retry-After-Ms'):
+        if name in headers:
+            return float(headers[name]) / 1000
+    for name in ('retry-after', 'Retry-After'):
+        if name in headers:
+            try:
+                return float(headers[name])
+            except ValueError:
+                return None
+    return None
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OpenAIScheduler()
+        return _scheduler
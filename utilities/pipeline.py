@@ -0,0 +1,62 @@
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utilities.tools import colorprint
+from utilities.instrumentation import profile_document
+
+FR_CONCURRENCY = int(os.getenv('FR_CONCURRENCY', 4))
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 4))
+
+
+def run_batch(files, analyze, answer, fr_concurrency=FR_CONCURRENCY, openai_concurrency=OPENAI_CONCURRENCY, on_result=None, on_error=None):
+    # Process every file through two stages: analyze(file) -> context (Form Recognizer)
+    # and answer(file, context) -> response_text (OpenAI).
+    # Each stage is bounded by its own semaphore, so while document N is waiting for
+    # completions, document N+1 can already be polled in Form Recognizer.
+    # Returns {filename: response_text} in the order of `files` (failed files are left out).
+    # on_result(file, response_text) / on_error(file, exception) are called as each document finishes.
+    fr_slots = threading.Semaphore(fr_concurrency)
+    openai_slots = threading.Semaphore(openai_concurrency)
+    max_workers = fr_concurrency + openai_concurrency
+
+    def process(file):
+        with profile_document(file['filename']):
+            with fr_slots:
+                context = analyze(file)
+            with openai_slots:
+                return answer(file, context)
+
+    results = {}
+    failed = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for index, file in enumerate(files):
+            pending[executor.submit(process, file)] = (index, file)
+            # keep a bounded number of documents in flight so `files` can be a lazy iterator
+            if len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done, pending, results, failed, on_result, on_error)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            _collect(done, pending, results, failed, on_result, on_error)
+    elapsed = time.time() - start
+
+    processed = len(results)
+    docs_per_minute = processed / elapsed * 60 if elapsed > 0 else 0.0
+    colorprint(f"Processed {processed} documents ({len(failed)} failed) in {elapsed:.1f}s: {docs_per_minute:.2f} docs/minute", '44')
+    return {file['filename']: response_text for _, (file, response_text) in sorted(results.items())}
+
+
+def _collect(done, pending, results, failed, on_result, on_error):
+    for future in done:
+        index, file = pending.pop(future)
+        try:
+            results[index] = (file, future.result())
+        except Exception as e:
+            failed.append(file['filename'])
+            colorprint(f"File {file['filename']} couldn't be processed: {e}", '9')
+            if on_error:
+                on_error(file, e)
+            continue
+        if on_result:
+            on_result(file, results[index][1])
@@ -1,4 +1,4 @@
-from redis import Redis
+from redis import Redis, ConnectionPool
 from redis.commands.search.query import Query
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.field import VectorField, TagField, TextField
@@ -8,6 +8,8 @@ import pandas as pd
 from pprint import pprint
 import hashlib
 import os
+import time
+from utilities.instrumentation import measure, instrumented
 
 embeddings_dims = {
     "text-search-davinci-doc-001": 12288,
@@ -17,6 +19,7 @@ embeddings_dims = {
 # Redis configuration
 DIM = embeddings_dims[os.getenv("OPENAI_EMBEDDINGS_ENGINE_DOC", "text-embedding-ada-002")]
 VECT_NUMBER = 3155
+REDIS_BATCH_SIZE = int(os.getenv('REDIS_BATCH_SIZE', 500))
 
 def create_index(redis_conn: Redis, index_name="embeddings-index", prefix = "embedding",number_of_vectors = VECT_NUMBER, distance_metric:str="COSINE"):
     text = TextField(name="text")
@@ -34,6 +37,7 @@ def create_index(redis_conn: Redis, index_name="embeddings-index", prefix = "emb
         definition = IndexDefinition(prefix=[prefix], index_type=IndexType.HASH)
     )
 
+@instrumented('execute_query', lambda df, np_vector, *args, **kwargs: {'bytes': np_vector.astype(dtype=np.float32).nbytes})
 def execute_query(np_vector:np.array, return_fields: list=[], search_type: str="KNN", number_of_results: int=20, vector_field_name: str="embeddings"):
     base_query = f'*=>[{search_type} {number_of_results} @{vector_field_name} $vec_param AS vector_score]'
     query = Query(base_query)\
@@ -60,20 +64,59 @@ def get_documents(number_of_results: int=VECT_NUMBER):
     else:
         return pd.DataFrame()
 
-def set_document(elem):
-    # Connect to the Redis server
-    redis_conn = Redis(host= os.environ.get('REDIS_ADDRESS','localhost'), port=6379, password=os.environ.get('REDIS_PASSWORD',None)) 
-    # Set Data
+def get_document_key(elem):
     hash_object = hashlib.sha1(elem['filename'].encode('utf-8')) if elem['filename'] else hashlib.sha1(elem['text'].encode('utf-8'))
-    index = hash_object.hexdigest()
-    redis_conn.hset(
-        f"embedding:{index}",
-        mapping={
-            "text": elem['text'],
-            "filename": elem['filename'],
-            "embeddings": np.array(elem['search_embeddings']).astype(dtype=np.float32).tobytes()
-        }
-    )
+    return f"embedding:{hash_object.hexdigest()}"
+
+class RedisEmbeddingStore:
+    # All connections come from one pool, bulk writes go through pipelines
+    def __init__(self, host=None, port=6379, password=None, max_connections=None):
+        self.pool = ConnectionPool(
+            host=host or os.environ.get('REDIS_ADDRESS','localhost'),
+            port=port,
+            password=password or os.environ.get('REDIS_PASSWORD',None),
+            max_connections=max_connections)
+        self.redis_conn = Redis(connection_pool=self.pool)
+        self.documents_written = 0
+        self.write_seconds = 0.0
+
+    def set_document(self, elem):
+        self.set_documents([elem])
+
+    def set_documents(self, elems, batch_size=REDIS_BATCH_SIZE):
+        # Write the documents in pipelines of batch_size hset commands, returns the number written
+        start = time.time()
+        written = 0
+        with measure('set_document') as counts:
+            counts['bytes'] = 0
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for elem in elems:
+                mapping = {
+                    "text": elem['text'],
+                    "filename": elem['filename'],
+                    "embeddings": np.array(elem['search_embeddings']).astype(dtype=np.float32).tobytes()
+                }
+                pipe.hset(get_document_key(elem), mapping=mapping)
+                counts['bytes'] += len(mapping['text'].encode('utf-8')) + len(mapping['embeddings'])
+                written += 1
+                if written % batch_size == 0:
+                    pipe.execute()
+            pipe.execute()
+        self.documents_written += written
+        self.write_seconds += time.time() - start
+        return written
+
+    def throughput(self):
+        # documents written per second since the store was created
+        return self.documents_written / self.write_seconds if self.write_seconds else 0.0
+
+def set_document(elem):
+    store.set_document(elem)
+
+def set_documents(elems, batch_size=REDIS_BATCH_SIZE):
+    written = store.set_documents(elems, batch_size)
+    print(f"Wrote {written} documents, {store.throughput():.1f} documents/s")
+    return written
 
 def delete_document(index):
     redis_conn.delete(f"{index}")
@@ -117,7 +160,8 @@ def delete_prompt_results(prefix="prompt*"):
         redis_conn.delete(*keys)
 
 # Connect to the Redis server
-redis_conn = Redis(host= os.environ.get('REDIS_ADDRESS','localhost'), port=6379, password=os.environ.get('REDIS_PASSWORD',None)) #api for Docker localhost for local execution
+store = RedisEmbeddingStore() #api for Docker localhost for local execution
+redis_conn = store.redis_conn
 
 # Check if Redis index exists
 index_name = "embeddings-index"
@@ -0,0 +1,128 @@
+import os, json, time, threading
+import pandas as pd
+
+RESULT_SINK_PATH = os.getenv('RESULT_SINK_PATH', os.path.join('data', 'results.jsonl')) # one row per (document, field), kept across runs
+RESULT_SINK_FSYNC_ROWS = int(os.getenv('RESULT_SINK_FSYNC_ROWS', 200)) # rows written between two fsync
+RESULT_SINK_FSYNC_SECONDS = float(os.getenv('RESULT_SINK_FSYNC_SECONDS', 10)) # seconds between two fsync
+
+
+def read_rows(path):
+    # rows of the sink, a last line cut by a crash is ignored
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class ResultSink:
+    # Append-only JSONL of the answers: {"document", "cache_key", "field", "answer", "time"} for every field of a
+    # document, written as soon as the document is answered. A document is done when the rows of its current
+    # cache_key cover all the fields, so a restarted batch only processes the others (and changed blobs).
+    def __init__(self, fields, path=RESULT_SINK_PATH, fsync_rows=RESULT_SINK_FSYNC_ROWS, fsync_seconds=RESULT_SINK_FSYNC_SECONDS):
+        self.fields = list(fields)
+        self.path = path
+        self.fsync_rows = fsync_rows
+        self.fsync_seconds = fsync_seconds
+        self.lock = threading.Lock()
+        self.field_bits = {field: 1 << i for i, field in enumerate(self.fields)}
+        self.all_fields = sum(set(self.field_bits.values()))
+        self.answered = {} # document: [cache_key, bit mask of the fields answered]
+        for row in read_rows(path):
+            self.add_answered(row['document'], row.get('cache_key'), row['field'])
+        self.file = None # opened on the first write, reading the sink (e.g. to pivot it) doesn't modify it
+        self.unsynced_rows = 0
+        self.last_fsync = time.monotonic()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path):
+            # drop the end of a row cut by a crash, so the next row doesn't get glued to it
+            with open(self.path, 'rb+') as f:
+                content = f.read()
+                if content and not content.endswith(b'\n'):
+                    f.truncate(content.rfind(b'\n') + 1)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def add_answered(self, document, cache_key, field):
+        state = self.answered.get(document)
+        if state is None or state[0] != cache_key:
+            state = self.answered[document] = [cache_key, 0]
+        state[1] |= self.field_bits.get(field, 0)
+
+    def is_done(self, file):
+        state = self.answered.get(file['filename'])
+        return state is not None and state[0] == file.get('cache_key') and state[1] == self.all_fields
+
+    def write(self, file, answers):
+        # rows of one document, answers in the order of the fields
+        now = time.time()
+        rows = [{'document': file['filename'], 'cache_key': file.get('cache_key'), 'field': field, 'answer': answer, 'time': now}
+                for field, answer in zip(self.fields, answers)]
+        data = ''.join(json.dumps(row) + '\n' for row in rows)
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.file.write(data)
+            self.file.flush()
+            for row in rows:
+                self.add_answered(row['document'], row['cache_key'], row['field'])
+            self.unsynced_rows += len(rows)
+            if self.unsynced_rows >= self.fsync_rows or time.monotonic() - self.last_fsync >= self.fsync_seconds:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced_rows = 0
+        self.last_fsync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and not self.file.closed:
+                self.file.flush()
+                self.sync()
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def to_dataframe(self):
+        # The result.csv shape: a Q column with the fields, then one column per document (file name without
+        # extension) with the latest answers of its current version, documents sorted by name
+        with self.lock:
+            if self.file is not None and not self.file.closed:
+                self.file.flush()
+            answers = {}
+            for row in read_rows(self.path):
+                state = self.answered.get(row['document'])
+                if state is not None and state[0] == row.get('cache_key') and row['field'] in self.field_bits:
+                    answers.setdefault(row['document'], {})[row['field']] = row['answer']
+        columns = {'Q': self.fields}
+        for document in sorted(answers):
+            columns[os.path.splitext(document)[0]] = [answers[document].get(field) for field in self.fields]
+        return pd.DataFrame(columns)
+
+    def to_csv(self, path=os.path.join('data', 'result.csv')):
+        df = self.to_dataframe()
+        df.to_csv(path)
+        return df
+
+
+if __name__ == '__main__':
+    # python -m utilities.resultsink [question file] [csv path]: result.csv of the documents answered so far,
+    # e.g. while a batch is still running
+    import sys
+    question_path = sys.argv[1] if len(sys.argv) > 1 else 'question.txt'
+    csv_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join('data', 'result.csv')
+    with open(question_path) as f:
+        question = f.read().splitlines()
+    with ResultSink(question[1:]) as sink:
+        print(sink.to_csv(csv_path))
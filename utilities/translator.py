@@ -1,33 +1,134 @@
-import os, requests, urllib
+import os, requests, urllib, threading
+from collections import deque
+from functools import lru_cache
+from utilities.langid import detect_language
+from utilities.instrumentation import measure, text_bytes
 
-def translate(text, language='en'):
-    endpoint_detect = os.environ['TRANSLATE_ENDPOINT'] + "/detect?api-version=3.0"
-    headers = {
+# Translator v3 limits per request
+TRANSLATE_MAX_ELEMENTS = int(os.getenv('TRANSLATE_MAX_ELEMENTS', 1000))
+TRANSLATE_MAX_CHARS = int(os.getenv('TRANSLATE_MAX_CHARS', 50000))
+# texts detected locally (utilities/langid.py) as the target language with this confidence are not sent
+LANGUAGE_PREDETECT = os.getenv('LANGUAGE_PREDETECT', 'true').lower() == 'true'
+LANGUAGE_PREDETECT_CONFIDENCE = float(os.getenv('LANGUAGE_PREDETECT_CONFIDENCE', 0.99))
+
+
+class TranslationStats:
+    def __init__(self):
+        self.local = 0 # texts kept as they are without calling the service
+        self.remote = 0 # texts sent to the service
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def add(self, local=0, remote=0, requests=0):
+        with self.lock:
+            self.local += local
+            self.remote += remote
+            self.requests += requests
+
+    def stats(self):
+        total = self.local + self.remote
+        return {'local': self.local, 'remote': self.remote, 'requests': self.requests, 'avoided_rate': self.local / total if total else 0.0}
+
+translation_stats = TranslationStats()
+
+@lru_cache(maxsize=None)
+def get_session():
+    # one keep-alive session for all the translator calls
+    session = requests.Session()
+    session.headers.update({
         'Ocp-Apim-Subscription-Key': os.environ['TRANSLATE_KEY'],
         'Ocp-Apim-Subscription-Region': os.environ['TRANSLATE_REGION'],
         'Content-type': 'application/json'
-    }
-    params = urllib.parse.urlencode({})
-    body = [{
-        'text': text
-    }]
-    request = requests.post(endpoint_detect, params=params, headers=headers, json=body)
-    response = request.json()
-    if (response[0]['language'] != language):
-        endpoint_translate = os.environ['TRANSLATE_ENDPOINT'] + "/translate?api-version=3.0"
-        params = urllib.parse.urlencode({
-            'api-version': '3.0',
-            'from': response[0]['language'],
-            'to': language
-        })
-        body = [{
-            'text': text
-        }]
-        request = requests.post(endpoint_translate, params=params, headers=headers, json=body)
+    })
+    return session
+
+def split_text(text, max_chars=TRANSLATE_MAX_CHARS):
+    # Cut texts longer than a request at the last line break (or space) that fits
+    pieces, separators = [], []
+    while len(text) > max_chars:
+        cut = text.rfind('\n', 0, max_chars)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, max_chars)
+        if cut <= 0:
+            pieces.append(text[:max_chars])
+            separators.append('')
+            text = text[max_chars:]
+            continue
+        pieces.append(text[:cut])
+        separators.append(text[cut])
+        text = text[cut + 1:]
+    pieces.append(text)
+    return pieces, separators
+
+def is_in_language(text, language='en'):
+    if not LANGUAGE_PREDETECT:
+        return False
+    detected, confidence = detect_language(text)
+    return detected == language and confidence >= LANGUAGE_PREDETECT_CONFIDENCE
+
+def post_translate(texts, language='en'):
+    # Without 'from' the service detects the language of every element and returns it with the translation,
+    # texts already in the target language are returned unchanged
+    endpoint_translate = os.environ['TRANSLATE_ENDPOINT'] + "/translate?api-version=3.0"
+    params = urllib.parse.urlencode({
+        'api-version': '3.0',
+        'to': language
+    })
+    body = [{'text': text} for text in texts]
+    with measure('translate') as counts:
+        counts['bytes'] = text_bytes(texts)
+        request = get_session().post(endpoint_translate, params=params, json=body)
+        request.raise_for_status()
         response = request.json()
-        return response[0]['translations'][0]['text']
-    else:
-        return text
+    translation_stats.add(remote=len(texts), requests=1)
+    return [text if r['detectedLanguage']['language'] == language else r['translations'][0]['text'] for text, r in zip(texts, response)]
+
+def translate_iter(texts, language='en'):
+    # Translate a stream of texts, packing as many as fit in one request (TRANSLATE_MAX_ELEMENTS, TRANSLATE_MAX_CHARS).
+    # Translations are yielded in the order of the texts, as soon as every piece of a text is back.
+    queue = deque() # (pieces, separators, translations) of the texts not yielded yet
+    batch = [] # (translations, piece index, piece) of the next request
+    batch_chars = 0
+
+    def send():
+        for (translations, i, _), translation in zip(batch, post_translate([piece for _, _, piece in batch], language)):
+            translations[i] = translation
+        batch.clear()
+
+    def pop_done():
+        while queue and None not in queue[0][2]:
+            pieces, separators, translations = queue.popleft()
+            yield ''.join(t + sep for t, sep in zip(translations, separators + ['']))
+
+    for text in texts:
+        if is_in_language(text, language):
+            translation_stats.add(local=1)
+            queue.append(([text], [], [text]))
+        else:
+            pieces, separators = split_text(text, TRANSLATE_MAX_CHARS)
+            translations = [None] * len(pieces)
+            queue.append((pieces, separators, translations))
+            for i, piece in enumerate(pieces):
+                if not piece.strip():
+                    translations[i] = piece
+                    continue
+                if batch and (len(batch) == TRANSLATE_MAX_ELEMENTS or batch_chars + len(piece) > TRANSLATE_MAX_CHARS):
+                    send()
+                    batch_chars = 0
+                    yield from pop_done()
+                batch.append((translations, i, piece))
+                batch_chars += len(piece)
+        if not batch:
+            yield from pop_done()
+    if batch:
+        send()
+    yield from pop_done()
+
+def translate_batch(texts, language='en'):
+    return list(translate_iter(texts, language))
+
+def translate(text, language='en'):
+    return translate_batch([text], language)[0]
     
 
 def get_available_languages():
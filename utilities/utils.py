@@ -2,14 +2,22 @@ import pandas as pd
 import numpy as np
 from openai.embeddings_utils import get_embedding, cosine_similarity
 import openai
-import os, io, zipfile, time
+import os, io, re, zipfile, time, weakref
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from transformers import GPT2Tokenizer
 #from utilities.redisembeddings import execute_query, get_documents, set_document
-from utilities.formrecognizer import analyze_read
-#from utilities.azureblobstorage import upload_file, upsert_blob_metadata
+from utilities.formrecognizer import analyze_read, analyze_read_stream
+from utilities.azureblobstorage import upload_file, upsert_blob_metadata
 from utilities.translator import *
+from utilities.completioncache import cached_completion
+from utilities.openaischeduler import count_tokens, get_encoding
+from utilities.cascade import get_default_cascade
+from utilities.vectorindex import LocalVectorIndex, LOCAL_INDEX_PATH
+from utilities.instrumentation import measure, count_retry
 import tiktoken
+from functools import lru_cache
+
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'redis') # redis or local (utilities/vectorindex.py)
 
 def initialize(engine='davinci'):
 
@@ -24,12 +32,38 @@ def initialize(engine='davinci'):
     print("openai.api_key: "+'***')
 
 
+_dataframe_indexes = {} # engine: (weak reference to the DataFrame, rows, LocalVectorIndex of its embeddings)
+
+def get_dataframe_index(df, engine='davinci'):
+    # the index of df's embeddings is built once and reused while the same DataFrame (with the same rows) is searched
+    cached = _dataframe_indexes.get(engine)
+    if cached is None or cached[0]() is not df or cached[1] != len(df):
+        cached = _dataframe_indexes[engine] = (weakref.ref(df), len(df), LocalVectorIndex(df[f'{engine}_search'].tolist()))
+    return cached[2]
+
 # Semantically search using the computed embeddings locally
 def search_semantic(df, search_query, n=3, pprint=True, engine='davinci'):
     embedding = get_embedding(search_query, engine= get_embeddings_model()['query'])
-    df['similarities'] = df[f'{engine}_search'].apply(lambda x: cosine_similarity(x, embedding))
+    index = get_dataframe_index(df, engine)
+    df['similarities'] = index.similarities(embedding)[0]
+    top, _ = index.search(embedding, n)
+
+    res = df.iloc[top]
+    if pprint:
+        for r in res:
+            print(r[:200])
+            print()
+    return res.reset_index()
+
+@lru_cache(maxsize=1)
+def get_local_index(path=LOCAL_INDEX_PATH):
+    return LocalVectorIndex.load(path)
+
+# Semantically search using the embeddings in the local index (VECTOR_STORE=local), no Redis needed
+def search_semantic_local(df, search_query, n=3, pprint=True, engine='davinci'):
+    embedding = get_embedding(search_query, engine= get_embeddings_model()['query'])
+    res = get_local_index().query(np.array(embedding), number_of_results=n)
 
-    res = df.sort_values('similarities', ascending=False).head(n)
     if pprint:
         for r in res:
             print(r[:200])
@@ -53,7 +87,10 @@ def get_semantic_answer(df, question, explicit_prompt="", model="DaVinci-text",
     restart_sequence = "\n\n"
     question += "\n"
 
-    res = search_semantic_redis(df, question, n=3, pprint=False, engine=engine)
+    if VECTOR_STORE == 'local':
+        res = search_semantic_local(df, question, n=3, pprint=False, engine=engine)
+    else:
+        res = search_semantic_redis(df, question, n=3, pprint=False, engine=engine)
 
     if len(res) == 0:
         prompt = f"{question}"
@@ -66,7 +103,7 @@ def get_semantic_answer(df, question, explicit_prompt="", model="DaVinci-text",
         prompt = f"{res_text}{restart_sequence}{question}"
             
 
-    response = openai.Completion.create(
+    response = cached_completion(
         engine=model,
         prompt=prompt,
         temperature=temperature,
@@ -85,39 +122,166 @@ def colorprint(txt,opt="222",end='\n'):
     #print(f'\033[{opt}m',txt,'\033[0m',end=end)
     print(u"\u001b[38;5;"+opt+'m'+txt+u"\u001b[0m",end=end)
 
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 16)) # inputs per Embedding.create request
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 32000)) # tokens per Embedding.create request
+
+@lru_cache(maxsize=None)
+def get_embedding_encoding(engine="text-embedding-ada-002"):
+    EMBEDDING_ENCODING = 'cl100k_base' if engine == 'text-embedding-ada-002' else 'gpt2'
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6), before_sleep=count_retry('embedding'))
 def get_embedding(text: str, engine="text-embedding-ada-002") -> list[float]:
     # replace newlines, which can negatively affect performance.
     text = text.replace("\n", " ")
-    EMBEDDING_ENCODING = 'cl100k_base' if engine == 'text-embedding-ada-002' else 'gpt2'
-    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
-    return openai.Embedding.create(input=encoding.encode(text), engine=engine)["data"][0]["embedding"]
-
+    encoding = get_embedding_encoding(engine)
+    tokens = encoding.encode(text)
+    with measure('embedding') as counts:
+        counts.update(prompt_tokens=len(tokens), bytes=len(text.encode('utf-8')))
+        return openai.Embedding.create(input=tokens, engine=engine)["data"][0]["embedding"]
+
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6), before_sleep=count_retry('embedding'))
+def create_embeddings(inputs: list[list[int]], engine="text-embedding-ada-002") -> list[list[float]]:
+    with measure('embedding') as counts:
+        counts['prompt_tokens'] = sum(len(i) for i in inputs)
+        data = openai.Embedding.create(input=inputs, engine=engine)["data"]
+    return [d["embedding"] for d in sorted(data, key=lambda d: d["index"])]
+
+def pack_embedding_batches(token_lists, max_inputs=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_BATCH_TOKENS):
+    # Group the inputs (by index) into requests under the input count and token limits
+    batch = []
+    batch_tokens = 0
+    for i, tokens in enumerate(token_lists):
+        if batch and (len(batch) == max_inputs or batch_tokens + len(tokens) > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += len(tokens)
+    if batch:
+        yield batch
+
+def get_embeddings_for_tokens(token_lists: list[list[int]], engine="text-embedding-ada-002") -> list[list[float]]:
+    embeddings = [None] * len(token_lists)
+    for batch in pack_embedding_batches(token_lists):
+        for i, embedding in zip(batch, create_embeddings([token_lists[i] for i in batch], engine)):
+            embeddings[i] = embedding
+    return embeddings
+
+def get_embeddings(texts: list[str], engine="text-embedding-ada-002") -> list[list[float]]:
+    # Batched get_embedding, the results are in the order of `texts`
+    encoding = get_embedding_encoding(engine)
+    return get_embeddings_for_tokens([encoding.encode(text.replace("\n", " ")) for text in texts], engine)
+
+
+def get_embedding_max_tokens(engine="text-embedding-ada-002"):
+    return 2000 if engine == 'text-embedding-ada-002' else 3000
 
 def chunk_and_embed(text: str, filename="", engine="text-embedding-ada-002"):
-    EMBEDDING_ENCODING = 'cl100k_base' if engine == 'text-embedding-ada-002' else 'gpt2'
-    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
-
-    full_data = {
-        "text": text,
-        "filename": filename,
-        "search_embeddings": None
-    }
+    return chunk_and_embed_many([text], [filename], engine)[0]
+
+def chunk_and_embed_many(texts: list[str], filenames: list[str], engine="text-embedding-ada-002"):
+    # Tokenize every text once and embed all of them in as few requests as possible.
+    # A text over the token limit gets None instead of its data.
+    encoding = get_embedding_encoding(engine)
+    max_length = get_embedding_max_tokens(engine)
+
+    full_data = [None] * len(texts)
+    token_lists = []
+    indices = []
+    for i, (text, filename) in enumerate(zip(texts, filenames)):
+        tokens = encoding.encode(text.replace("\n", " "))
+        if len(tokens) > max_length:
+            continue
+        full_data[i] = {
+            "text": text,
+            "filename": filename,
+            "search_embeddings": None
+        }
+        token_lists.append(tokens)
+        indices.append(i)
+
+    for i, embedding in zip(indices, get_embeddings_for_tokens(token_lists, engine)):
+        full_data[i]['search_embeddings'] = embedding
 
-    text = text.replace("\n", " ")
-    lenght = len(encoding.encode(text))
-    if engine == 'text-embedding-ada-002' and lenght > 2000:
-        return None
-    elif lenght > 3000:
-        return None
+    return full_data
 
-    full_data['search_embeddings'] = get_embedding(text, engine)
 
-    return full_data
+RETRIEVAL_MIN_TOKENS = int(os.getenv('RETRIEVAL_MIN_TOKENS', 3000)) # shorter documents are sent whole with every question
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv('RETRIEVAL_CHUNK_TOKENS', 500)) # longer page buckets are split on line breaks
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', 4))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv('RETRIEVAL_TOKEN_BUDGET', 1500)) # context tokens per question
+
+def split_by_tokens(text, max_tokens, model='text-davinci-003'):
+    # Pieces of at most max_tokens cut on line breaks, a longer single line is cut between tokens
+    pieces = []
+    piece = []
+    piece_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line, model)
+        if piece and piece_tokens + line_tokens > max_tokens:
+            pieces.append(''.join(piece))
+            piece = []
+            piece_tokens = 0
+        if line_tokens > max_tokens:
+            pieces += split_tokens(line, max_tokens, model)
+            continue
+        piece.append(line)
+        piece_tokens += line_tokens
+    if piece:
+        pieces.append(''.join(piece))
+    return pieces
+
+def split_tokens(text, max_tokens, model='text-davinci-003'):
+    # Pieces of at most max_tokens tokens, cut where a token boundary is also a character boundary
+    # (a slice ending inside a multi-byte character decodes to a trailing U+FFFD), so they join back into text
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        piece = encoding.decode(tokens[start:end])
+        while end < len(tokens) and end - start > 1 and piece.endswith('\ufffd'):
+            end -= 1
+            piece = encoding.decode(tokens[start:end])
+        pieces.append(piece)
+        start = end
+    return pieces
+
+@lru_cache(maxsize=None)
+def get_question_embeddings(questions: tuple, engine="text-embedding-ada-002"):
+    # the question.txt fields are the same for every document, they are embedded once per run
+    return get_embeddings(list(questions), engine)
+
+def get_scoped_contexts(chunks, questions, model='text-davinci-003', top_k=RETRIEVAL_TOP_K, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    # One context per question with only its top_k most similar chunks (in document order) under token_budget tokens.
+    # chunks are the page buckets of analyze_read. None when the document is short enough to be sent whole.
+    engines = get_embeddings_model()
+    # each piece is embedded on its own, so it also has to fit the input of the embedding model
+    max_tokens = min(RETRIEVAL_CHUNK_TOKENS, get_embedding_max_tokens(engines['doc']))
+    pieces = [p for chunk in chunks for p in split_by_tokens(chunk, max_tokens, model) if p.strip()]
+    piece_tokens = [count_tokens(p, model) for p in pieces]
+    if sum(piece_tokens) <= RETRIEVAL_MIN_TOKENS:
+        return None
+    index = LocalVectorIndex(get_embeddings(pieces, engines['doc']))
+    top_pieces, _ = index.search_batch(get_question_embeddings(tuple(questions), engines['query']), top_k)
+    contexts = []
+    for top in top_pieces:
+        selected = []
+        used_tokens = 0
+        for i in top:
+            if selected and used_tokens + piece_tokens[i] > token_budget:
+                continue
+            selected.append(i)
+            used_tokens += piece_tokens[i]
+        contexts.append(''.join(pieces[i] for i in sorted(selected)))
+    return contexts
 
 
 def get_completion(prompt="", max_tokens=400, model="text-davinci-003"):
-    response = openai.Completion.create(
+    response = cached_completion(
         engine=model,
         prompt=prompt,
         temperature=1,
@@ -148,94 +312,132 @@ def get_embeddings_model():
 
 
 def add_embeddings(text, filename, engine="text-embedding-ada-002"):
-    embeddings = chunk_and_embed(text, filename, engine)
-    if embeddings:
-        # Store embeddings in Redis
-        set_document(embeddings)
+    add_embeddings_many([text], [filename], engine)
+
+def add_embeddings_many(texts, filenames, engine="text-embedding-ada-002"):
+    documents = []
+    for filename, embeddings in zip(filenames, chunk_and_embed_many(texts, filenames, engine)):
+        if embeddings:
+            documents.append(embeddings)
+        else:
+            colorprint(f"No embeddings were created for {filename} as it's too long. Please keep it under 3000 tokens", '9')
+    if VECTOR_STORE == 'local':
+        # appended to the files, the cached index is reloaded (memory-mapped) on the next search
+        LocalVectorIndex.append(documents)
+        get_local_index.cache_clear()
     else:
-        set.error("No embeddings were created for this document as it's too long. Please keep it under 3000 tokens")
+        # imported here, utilities.redisembeddings connects to Redis on import
+        from utilities.redisembeddings import set_documents
+        # Store embeddings in Redis
+        set_documents(documents)
 
 
 def convert_file_and_add_embeddings(fullpath, filename, enable_translation=False):
-    # Extract the text from the file
-    text = analyze_read(fullpath)
-    # Upload the text to Azure Blob Storage
+    # Extract the text from the file, chunk by chunk; translated chunks are packed into as few requests as fit
+    text = []
     zip_file = io.BytesIO()
+    chunks = analyze_read_stream(fullpath)
     if enable_translation:
-        text = list(map(lambda x: translate(x), text))
-    for k, v in enumerate(text):
-        with zipfile.ZipFile(zip_file, mode="a") as archive:
+        chunks = translate_iter(chunks)
+    with zipfile.ZipFile(zip_file, mode="a") as archive:
+        for k, v in enumerate(chunks):
             archive.writestr(f"{k}.txt", v)
+            text.append(v)
+    if enable_translation:
+        print(f"Translation: {translation_stats.stats()}")
+    # Upload the text to Azure Blob Storage
     upload_file(zip_file.getvalue(), f"converted/{filename}.zip", content_type='application/zip')
     upsert_blob_metadata(filename, {"converted": "true"})
-    for k, t in enumerate(text):
-        add_embeddings(t, f"{filename}_chunk_{k}", os.getenv('OPENAI_EMBEDDINGS_ENGINE_DOC', 'text-embedding-ada-002'))
+    add_embeddings_many(text, [f"{filename}_chunk_{k}" for k in range(len(text))], os.getenv('OPENAI_EMBEDDINGS_ENGINE_DOC', 'text-embedding-ada-002'))
 
-def get_openAI_response(context='lores ipsum',secondary_context='',question=['tl;dr'],model='text-davinci-003',temperature=0,tokens_response=15,restart_sequence=15):
+def complete_prompt(prompt, model='text-davinci-003', temperature=0, tokens_response=15):
+    # rate limits and retries are handled by utilities.openaischeduler
+    response = cached_completion(
+        engine=model,
+        prompt=prompt,
+        temperature=temperature,
+        max_tokens=tokens_response,
+        top_p=0.5,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=None
+    )
+    return response['choices'][0]['text'].strip(' \n:?')
+
+
+MULTI_FIELD_INSTRUCTION = 'Answer every numbered field below on its own line, in the form "<number>: <answer>".'
+MULTI_FIELD_LINE = re.compile(r'^\s*(\d+)\s*[:.)]\s*(.*)$')
+
+def ask_all_fields(context, instruction, fields, model='text-davinci-003', temperature=0, tokens_response=15, restart_sequence='\n\n'):
+    # Ask for all the fields in one completion instead of one completion per field.
+    # Returns the answers in the order of `fields`; a field the answer couldn't be parsed for is None.
+    numbered_fields = '\n'.join(f"{i}. {q.strip().rstrip(':')}" for i, q in enumerate(fields, start=1))
+    prompt = f"{context}{restart_sequence}{instruction}\n{MULTI_FIELD_INSTRUCTION}\n{numbered_fields}\n\nAnswers:\n"
+    text = complete_prompt(prompt, model=model, temperature=temperature, tokens_response=(tokens_response + 5) * len(fields))
+    return parse_field_answers(text, fields)
+
+def get_field_labels(field):
+    # how a model may echo a field: the whole label, or the part before its explanation in parentheses
+    label = field.strip().rstrip(':').strip().lower()
+    return {label, label.split('(')[0].strip()} - {''}
+
+def strip_field_label(answer, labels):
+    # "Patient Name: John" -> "John" when the text before the first ':' is a label of the field
+    head, colon, rest = answer.partition(':')
+    return rest if colon and head.strip().lower() in labels else answer
+
+def parse_field_answers(text, fields):
+    # Answers of ask_all_fields in the order of `fields`, from "<number>: <answer>" lines. An echoed label
+    # ("1. Patient Name: John") is removed so the answer is the same as the per-field path; lines without
+    # a number are matched by their label, numbers out of range are ignored.
+    labels = [get_field_labels(q) for q in fields]
+    answers = [None] * len(fields)
+    for line in text.splitlines():
+        match = MULTI_FIELD_LINE.match(line)
+        if match:
+            i = int(match.group(1)) - 1
+            if not 0 <= i < len(fields):
+                continue
+            r = strip_field_label(match.group(2), labels[i])
+        else:
+            head = line.partition(':')[0].strip().lower()
+            i = next((j for j, field_labels in enumerate(labels) if head in field_labels), None)
+            if i is None:
+                continue
+            r = strip_field_label(line, labels[i])
+        r = r.strip(' \n:?')
+        if answers[i] is None and r:
+            answers[i] = r
+    return answers
+
+def get_openAI_response(context='lores ipsum',secondary_context='',question=['tl;dr'],model='text-davinci-003',temperature=0,tokens_response=15,restart_sequence=15,single_call=False,cascade=None):
+    # Each field goes through the cascade (utilities/cascade.py), by default the key-value/checkbox context
+    # first and the lines and tables of the document only when the answer is Unknown
+    cascade = cascade or get_default_cascade(model, tokens_response)
+    contexts = {'primary': context, 'secondary': secondary_context, 'full': f"{context}\n{secondary_context}"}
     question_text=[]
     response_text=[]
     instruction = question[0]
     colorprint(instruction,'20')
-    for q in question[1:]:
-        prompt = f"{context}{restart_sequence}{instruction}{''+q}"
-        try:
-            response = openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=tokens_response,
-                top_p=0.5,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-        except:
-            time.sleep(7)
-            response = openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=tokens_response,
-                top_p=0.5,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-        r=response['choices'][0]['text'].strip(' \n\:?')
-        r2=''
+    first_tier = cascade.tiers[0]
+    if single_call:
+        answers = ask_all_fields(contexts[first_tier.context], instruction, question[1:], model=first_tier.model, temperature=temperature, tokens_response=first_tier.max_tokens, restart_sequence=restart_sequence)
+    else:
+        answers = [None] * len(question[1:])
+    for q, r in zip(question[1:], answers):
+        if r is None:
+            # per-question path, also the fallback for fields the single call didn't answer
+            attempts = cascade.ask(contexts, instruction, q, temperature=temperature, restart_sequence=restart_sequence)
+        elif cascade.escalation_reason(first_tier, q, r) is not None:
+            attempts = [(first_tier.name, r)] + cascade.ask(contexts, instruction, q, temperature=temperature, restart_sequence=restart_sequence, first_tier=1)
+        else:
+            attempts = [(first_tier.name, r)]
 
         colorprint(q, '33', end=' ')
-        colorprint(r,'22',end=' ')  
-        
-        if r=='Unknown':
-            prompt = f"{secondary_context}{restart_sequence}{instruction}{''+q}"
-            try:
-                response = openai.Completion.create(
-                    engine=model,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=tokens_response,
-                    top_p=0.5,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stop=None
-                )
-            except:
-                time.sleep(7)
-                response = openai.Completion.create(
-                    engine=model,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=tokens_response,
-                    top_p=0.5,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stop=None
-                )
-            r=response['choices'][0]['text'].strip(' \n\:?')
-            colorprint(r,'11',end='')
+        for k, (tier_name, r) in enumerate(attempts):
+            colorprint(r,'22' if k == 0 else '11',end=' ')
         response_text.append(r)
         question_text.append(q)
         print('')
     print('')
-    return([question_text,response_text])
\ No newline at end of file
+    return([question_text,response_text])
@@ -0,0 +1,146 @@
+import os, json, tempfile
+import numpy as np
+import pandas as pd
+
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', os.path.join('data', 'embeddings-index'))
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class LocalVectorIndex:
+    # In-process cosine similarity index: all embeddings in one float32 matrix with unit-length rows,
+    # so a query is one matrix-vector product. Stored as <path>.f32 (the raw rows, memory-mapped on load),
+    # <path>.jsonl (one metadata line per row) and <path>.header.json (dimensions, committed rows and
+    # metadata bytes). New documents are appended in place: a loaded index keeps reading its own rows,
+    # and rows written after the last header update (e.g. cut by a crash) are dropped by the next append.
+    def __init__(self, embeddings, metadata=None, normalized=False):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.size == 0:
+            matrix = matrix.reshape(0, 0)
+        self.matrix = matrix if normalized else normalize_rows(matrix).astype(np.float32)
+        self.metadata = metadata if metadata is not None else [{} for _ in range(len(self.matrix))]
+
+    @classmethod
+    def from_documents(cls, documents):
+        # documents as stored by redisembeddings.set_documents: {'text', 'filename', 'search_embeddings'}
+        documents = list(documents)
+        return cls([d['search_embeddings'] for d in documents], [{'text': d['text'], 'filename': d['filename']} for d in documents])
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def add_documents(self, documents):
+        other = LocalVectorIndex.from_documents(documents)
+        if len(other) == 0:
+            return
+        self.matrix = other.matrix if len(self) == 0 else np.vstack([self.matrix, other.matrix])
+        self.metadata = self.metadata + other.metadata
+
+    def similarities(self, query_embeddings):
+        # cosine similarity of each query (rows) with every stored embedding (columns)
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        if len(self) == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32)
+        return queries @ self.matrix.T
+
+    def search_batch(self, query_embeddings, k=3):
+        # top-k indices and similarities for every query, best first
+        similarities = self.similarities(query_embeddings)
+        k = min(k, similarities.shape[1])
+        if k == 0:
+            empty = np.empty((similarities.shape[0], 0))
+            return empty.astype(int), empty
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_similarities, order, axis=1)
+
+    def search(self, query_embedding, k=3):
+        indices, similarities = self.search_batch(query_embedding, k)
+        return indices[0], similarities[0]
+
+    def query(self, query_embedding, number_of_results=20):
+        # Same frame as redisembeddings.execute_query (vector_score is the cosine distance)
+        indices, similarities = self.search(query_embedding, number_of_results)
+        return pd.DataFrame([{
+            'id': int(i),
+            'text': self.metadata[i].get('text', ''),
+            'filename': self.metadata[i].get('filename', ''),
+            'vector_score': float(1 - s)
+        } for i, s in zip(indices, similarities)])
+
+    def save(self, path=LOCAL_INDEX_PATH):
+        # Rewrite the whole index, the files are replaced so an index loaded from them keeps its rows
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        matrix = np.ascontiguousarray(self.matrix, dtype=np.float32)
+        metadata = ''.join(json.dumps(m) + '\n' for m in self.metadata).encode('utf-8')
+        replace_file(f"{path}.f32", matrix.tobytes())
+        replace_file(f"{path}.jsonl", metadata)
+        write_header(path, matrix.shape[1] if len(matrix) else 0, len(matrix), len(metadata))
+
+    @staticmethod
+    def append(documents, path=LOCAL_INDEX_PATH):
+        # Add documents at the end of the stored index without reading or rewriting it, returns the rows added
+        other = LocalVectorIndex.from_documents(documents)
+        if len(other) == 0:
+            return 0
+        header = read_header(path)
+        if header is None or header['rows'] == 0:
+            other.save(path)
+            return len(other)
+        if other.matrix.shape[1] != header['dimensions']:
+            raise ValueError(f"Embeddings of {other.matrix.shape[1]} dimensions can't be added to the {header['dimensions']} dimensions index {path}")
+        metadata = ''.join(json.dumps(m) + '\n' for m in other.metadata).encode('utf-8')
+        for suffix, committed, data in (('.f32', header['rows'] * header['dimensions'] * 4, other.matrix.tobytes()),
+                                        ('.jsonl', header['metadata_bytes'], metadata)):
+            with open(f"{path}{suffix}", 'r+b') as f:
+                f.truncate(committed)
+                f.seek(committed)
+                f.write(data)
+        write_header(path, header['dimensions'], header['rows'] + len(other), header['metadata_bytes'] + len(metadata))
+        return len(other)
+
+    @classmethod
+    def load(cls, path=LOCAL_INDEX_PATH):
+        header = read_header(path)
+        if header is None:
+            raise FileNotFoundError(f"No local index at {path}")
+        if header['rows']:
+            matrix = np.memmap(f"{path}.f32", dtype=np.float32, mode='r', shape=(header['rows'], header['dimensions']))
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        with open(f"{path}.jsonl", 'rb') as f:
+            metadata = [json.loads(line) for line in f.read(header['metadata_bytes']).splitlines()]
+        return cls(matrix, metadata, normalized=True)
+
+    @classmethod
+    def load_or_create(cls, path=LOCAL_INDEX_PATH):
+        if read_header(path) is not None:
+            return cls.load(path)
+        return cls(np.empty((0, 0), dtype=np.float32), [])
+
+
+def replace_file(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def read_header(path):
+    try:
+        with open(f"{path}.header.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_header(path, dimensions, rows, metadata_bytes):
+    # written last: rows appended after the previous header only count once it is replaced
+    replace_file(f"{path}.header.json", json.dumps({'dimensions': dimensions, 'rows': rows, 'metadata_bytes': metadata_bytes}).encode('utf-8'))